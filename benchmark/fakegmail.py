@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+
+"""
+A local IMAP server pretending to be gmail, for the benchmarks.
+
+It knows just enough of IMAP and X-GM-EXT-1 for the scripts here: LOGIN,
+CAPABILITY, ENABLE, SELECT/EXAMINE with UIDVALIDITY, UIDNEXT and
+HIGHESTMODSEQ, (UID) FETCH of X-GM-MSGID, X-GM-THRID, X-GM-LABELS, UID,
+MODSEQ and the Message-ID header, with CHANGEDSINCE, and (UID) COPY and
+(UID) STORE of X-GM-LABELS, (UID) SEARCH X-GM-LABELS, LIST, IDLE and
+COMPRESS=DEFLATE.  Any login is accepted.
+
+    python3 benchmark/fakegmail.py --messages 10000 --latency 0.05
+
+prints the port it listens on once it is ready.
+"""
+
+import argparse
+import os
+import queue
+import re
+import socket
+import socketserver
+import ssl
+import sys
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+# self signed, for localhost and 127.0.0.1 only
+CERTIFICATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'localhost.pem')
+
+class Store:
+    """ the mailbox, shared by all connections """
+    def __init__(self, messages, latency=0.0, refuse=(), maxconn=15, compress=True):
+        self.lock = threading.Lock()
+        self.uidvalidity = 12345
+        self.modseq = 1000
+        self.messages = []
+        for message in messages:
+            self.modseq += 1
+            self.messages.append(dict(message, modseq=self.modseq))
+        self.uidnext = max([m['uid'] for m in self.messages] + [0]) + 1
+        self.byuid = dict((m['uid'], n) for n, m in enumerate(self.messages))
+        # round trip time added to every command
+        self.latency = latency
+        # sequence numbers gmail "can't fetch", any FETCH including them gets a NO
+        self.refuse = set(refuse)
+        # gmail allows 15 connections per account
+        self.maxconn = maxconn
+        # whether COMPRESS=DEFLATE is offered
+        self.compress = compress
+        # drop every connection when this many more FETCH commands came in, once
+        self.drop_after = None
+        self.connections = set()
+
+    def select(self, msgset, uid):
+        """ indexes of the messages in msgset """
+        last = self.messages[-1]['uid'] if uid else len(self.messages)
+        for part in msgset.split(','):
+            first, _, end = part.partition(':')
+            first = last if first == '*' else int(first)
+            end = first if end == '' else last if end == '*' else int(end)
+            first, end = min(first, end), max(first, end)
+            if uid:
+                for n in range(first, min(end, last) + 1):
+                    if n in self.byuid:
+                        yield self.byuid[n]
+            else:
+                yield from range(first - 1, min(end, last))
+
+    def disconnect(self):
+        """ drops every open connection, like gmail does now and then """
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def change_labels(self, n, labels):
+        message = self.messages[n]
+        labels = sorted(set(labels))
+        if labels != message['labels']:
+            self.modseq += 1
+            message['labels'] = labels
+            message['modseq'] = self.modseq
+
+label_list_re = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+
+def parse_labels(text):
+    return [re.sub(r'\\(.)', r'\1', quoted) if quoted else atom for quoted, atom in label_list_re.findall(text)]
+
+class Handler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.deflate != None:
+            data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        store = self.server.store
+        # zlib streams once COMPRESS is on
+        self.deflate = None
+        self.inflate = None
+        with store.lock:
+            if len(store.connections) >= store.maxconn:
+                self.send('* BYE Too many simultaneous connections\r\n')
+                return
+            store.connections.add(self.request)
+        try:
+            self.send('* OK fake gmail ready\r\n')
+            # read ahead in a thread, so pipelined commands are timed from when they arrived
+            lines = self.lines = queue.Queue()
+            def reader():
+                buffer = b''
+                while True:
+                    try:
+                        data = self.rfile.read1(1 << 16)
+                    except (OSError, ValueError):
+                        data = b''
+                    if not data:
+                        lines.put((b'', time.time()))
+                        break
+                    # the client only compresses once it had the OK to COMPRESS,
+                    # by which time inflate is set
+                    buffer += self.inflate.decompress(data) if self.inflate != None else data
+                    while b'\n' in buffer:
+                        line, _, buffer = buffer.partition(b'\n')
+                        lines.put((line + b'\n', time.time()))
+            threading.Thread(target=reader, daemon=True).start()
+            while True:
+                line, received = lines.get()
+                if not line:
+                    break
+                tag, _, rest = line.decode('utf-8').rstrip('\r\n').partition(' ')
+                command, _, args = rest.partition(' ')
+                uid = command.upper() == 'UID'
+                if uid:
+                    command, _, args = args.partition(' ')
+                if store.latency and received + store.latency > time.time():
+                    time.sleep(received + store.latency - time.time())
+                if command.upper() == 'FETCH' and store.drop_after != None:
+                    with store.lock:
+                        store.drop_after -= 1
+                        drop = store.drop_after <= 0
+                        if drop:
+                            store.drop_after = None
+                    if drop:
+                        store.disconnect()
+                        break
+                method = getattr(self, 'cmd_' + command.upper(), None)
+                if method == None:
+                    self.send('%s BAD unknown command\r\n' % tag)
+                elif method(tag, args, uid) == 'BYE':
+                    break
+        finally:
+            with store.lock:
+                store.connections.discard(self.request)
+
+    def cmd_CAPABILITY(self, tag, args, uid):
+        compress = ' COMPRESS=DEFLATE' if self.server.store.compress else ''
+        self.send('* CAPABILITY IMAP4rev1 X-GM-EXT-1 UIDPLUS CONDSTORE ENABLE%s\r\n%s OK done\r\n' % (compress, tag))
+
+    def cmd_LOGIN(self, tag, args, uid):
+        self.send('%s OK logged in\r\n' % tag)
+
+    def cmd_ENABLE(self, tag, args, uid):
+        self.send('* ENABLED %s\r\n%s OK done\r\n' % (args, tag))
+
+    def cmd_COMPRESS(self, tag, args, uid):
+        if not self.server.store.compress or args.upper() != 'DEFLATE':
+            self.send('%s BAD not supported\r\n' % tag)
+        elif self.deflate != None:
+            self.send('%s NO [COMPRESSIONACTIVE] already compressing\r\n' % tag)
+        else:
+            self.inflate = zlib.decompressobj(-15)
+            self.send('%s OK DEFLATE active\r\n' % tag)
+            self.deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def cmd_NOOP(self, tag, args, uid):
+        self.send('%s OK done\r\n' % tag)
+
+    def cmd_LOGOUT(self, tag, args, uid):
+        self.send('* BYE bye\r\n%s OK done\r\n' % tag)
+        return 'BYE'
+
+    def cmd_IDLE(self, tag, args, uid):
+        # reports changes made over other connections until DONE
+        store = self.server.store
+        with store.lock:
+            seen = store.modseq
+        self.send('+ idling\r\n')
+        while True:
+            try:
+                line, received = self.lines.get(timeout=0.1)
+            except queue.Empty:
+                with store.lock:
+                    changed = [(n + 1, m) for n, m in enumerate(store.messages) if m['modseq'] > seen]
+                    seen = store.modseq
+                for seq, message in changed:
+                    self.send('* %d FETCH (UID %d MODSEQ (%d))\r\n' % (seq, message['uid'], message['modseq']))
+                continue
+            if not line:
+                return 'BYE'
+            if line.strip().upper() == b'DONE':
+                self.send('%s OK IDLE terminated (Success)\r\n' % tag)
+            else:
+                self.send('%s BAD expected DONE\r\n' % tag)
+            return
+
+    def cmd_LIST(self, tag, args, uid):
+        # every label is a folder, the system ones with special-use attributes
+        store = self.server.store
+        special = {'\\Inbox': ('', 'INBOX'), '\\Sent': ('\\Sent', '[Gmail]/Sent Mail'),
+            '\\Starred': ('\\Flagged', '[Gmail]/Starred'), '\\Important': ('\\Important', '[Gmail]/Important'),
+            '\\Draft': ('\\Drafts', '[Gmail]/Drafts')}
+        with store.lock:
+            labels = set(label for message in store.messages for label in message['labels'])
+        lines = ['* LIST (\\HasChildren \\Noselect) "/" "[Gmail]"',
+            '* LIST (\\HasNoChildren \\All) "/" "[Gmail]/All Mail"',
+            '* LIST (\\HasNoChildren \\Trash) "/" "[Gmail]/Trash"']
+        for label in sorted(labels):
+            attribute, name = special.get(label, ('', label))
+            lines.append('* LIST (\\HasNoChildren%s) "/" %s' % (' ' + attribute if attribute else '', synthetic.quote_label(name)))
+        self.send(''.join(line + '\r\n' for line in lines) + '%s OK Success\r\n' % tag)
+
+    def cmd_SEARCH(self, tag, args, uid):
+        store = self.server.store
+        m = re.match(r'X-GM-LABELS (.*)$', args, re.I)
+        if m == None:
+            self.send('%s BAD only X-GM-LABELS can be searched here\r\n' % tag)
+            return
+        label = parse_labels(m.group(1))[0]
+        with store.lock:
+            found = [message['uid'] if uid else n + 1 for n, message in enumerate(store.messages) if label in message['labels']]
+        self.send('* SEARCH%s\r\n%s OK SEARCH completed (Success)\r\n' % (''.join(' %d' % n for n in found), tag))
+
+    def cmd_SELECT(self, tag, args, uid):
+        store = self.server.store
+        with store.lock:
+            self.send('* %d EXISTS\r\n* OK [UIDVALIDITY %d]\r\n* OK [UIDNEXT %d]\r\n* OK [HIGHESTMODSEQ %d]\r\n%s OK done\r\n'
+                % (len(store.messages), store.uidvalidity, store.uidnext, store.modseq, tag))
+
+    cmd_EXAMINE = cmd_SELECT
+
+    def cmd_FETCH(self, tag, args, uid):
+        store = self.server.store
+        m = re.match(r'(\S+) \((.*?\]?)\)(?: \(CHANGEDSINCE (\d+)\))?$', args)
+        msgset, items, changedsince = m.groups()
+        items = items.upper()
+        out = []
+        with store.lock:
+            for n in store.select(msgset, uid):
+                if n + 1 in store.refuse:
+                    self.send('%s NO Some messages could not be FETCHed (Failure)\r\n' % tag)
+                    return
+                message = store.messages[n]
+                if changedsince != None and message['modseq'] <= int(changedsince):
+                    continue
+                parts = []
+                if 'X-GM-THRID' in items:
+                    parts.append('X-GM-THRID %d' % message['thrid'])
+                if 'X-GM-MSGID' in items:
+                    parts.append('X-GM-MSGID %d' % message['gmailid'])
+                if 'X-GM-LABELS' in items:
+                    parts.append('X-GM-LABELS (%s)' % ' '.join(synthetic.quote_label(l) for l in message['labels']))
+                if uid or re.search(r'(^| )UID( |$)', items):
+                    parts.append('UID %d' % message['uid'])
+                if changedsince != None or 'MODSEQ' in items:
+                    parts.append('MODSEQ (%d)' % message['modseq'])
+                response = ('* %d FETCH (%s' % (n + 1, ' '.join(parts))).encode('utf-8')
+                if 'MESSAGE-ID' in items:
+                    header = ('Message-ID: %s\r\n\r\n' % message['msgid'] if message['msgid'] else '\r\n').encode('utf-8')
+                    response += b' BODY[HEADER.FIELDS (MESSAGE-ID)] {%d}\r\n%s)\r\n' % (len(header), header)
+                else:
+                    response += b')\r\n'
+                out.append(response)
+        self.send(b''.join(out) + b'%s OK Success\r\n' % tag.encode('utf-8'))
+
+    def cmd_COPY(self, tag, args, uid):
+        # copying to a label's folder adds that label
+        store = self.server.store
+        msgset, label = args.split(' ', 1)
+        label = parse_labels(label)[0]
+        with store.lock:
+            for n in store.select(msgset, uid):
+                store.change_labels(n, store.messages[n]['labels'] + [label])
+        self.send('%s OK Success\r\n' % tag)
+
+    def cmd_STORE(self, tag, args, uid):
+        store = self.server.store
+        m = re.match(r'(\S+) ([+-]?)X-GM-LABELS(?:\.SILENT)? \((.*)\)$', args, re.I)
+        if m == None:
+            self.send('%s BAD only X-GM-LABELS can be stored here\r\n' % tag)
+            return
+        msgset, mode, labels = m.groups()
+        labels = parse_labels(labels)
+        with store.lock:
+            for n in store.select(msgset, uid):
+                old = store.messages[n]['labels']
+                if mode == '+':
+                    store.change_labels(n, old + labels)
+                elif mode == '-':
+                    store.change_labels(n, [l for l in old if l not in labels])
+                else:
+                    store.change_labels(n, labels)
+        self.send('%s OK Success\r\n' % tag)
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, store):
+        socketserver.TCPServer.__init__(self, address, Handler)
+        self.store = store
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(CERTIFICATE)
+        self.socket = ctx.wrap_socket(self.socket, server_side=True)
+
+def start(store, port=0):
+    """ serves store in a background thread, returns the server """
+    server = Server(('127.0.0.1', port), store)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake gmail IMAP server for benchmarking.')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--labels', type=int, default=20, help='number of user labels')
+    parser.add_argument('--missing-ids', type=float, default=0.0, help='fraction of messages without a Message-ID')
+    parser.add_argument('--duplicate-ids', type=float, default=0.0, help='fraction of messages reusing a Message-ID')
+    parser.add_argument('--latency', type=float, default=0.0, help='round trip time in seconds')
+    parser.add_argument('--refuse', type=int, nargs='*', default=[], help='sequence numbers to refuse fetching')
+    parser.add_argument('--no-compress', action='store_true', help='don\'t offer COMPRESS=DEFLATE')
+    parser.add_argument('--strip-labels', action='store_true', help='start with only the system labels, like a fresh account')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    messages = synthetic.generate(args.messages, args.seed, args.labels, args.missing_ids, args.duplicate_ids)
+    if args.strip_labels:
+        for message in messages:
+            message['labels'] = [l for l in message['labels'] if l in synthetic.SYSTEM_LABELS]
+    server = start(Store(messages, args.latency, args.refuse, compress=not args.no_compress), args.port)
+    print(server.server_address[1], flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+
+"""
+Times the label sync and restore against a synthetic Maildir and a local
+fake gmail server, and records the results as JSON:
+
+    python3 benchmark/run.py --messages 20000 --latency 0.05 --output before.json
+    ... change things ...
+    python3 benchmark/run.py --messages 20000 --latency 0.05 --output after.json
+    python3 benchmark/run.py --compare before.json after.json
+
+The same parameters and seed always give the same mail, so runs with the
+same parameters can be compared.
+"""
+
+import argparse
+import asyncio
+import datetime
+import email.header
+import email.parser
+import importlib.machinery
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARK)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARK)
+
+import fakegmail
+import gmailimap
+import synthetic
+
+FORMAT_VERSION = 1
+
+def config_values(args, maildir, port):
+    return dict(
+        MAILDIR=maildir,
+        LOGIN='bench@example.com',
+        PASSWORD='password',
+        IMAP_FOLDER='[Gmail]/All Mail',
+        IMAP_SERVER='127.0.0.1',
+        IMAP_PORT=port,
+        IMAP_CA_FILE=fakegmail.CERTIFICATE,
+        INDEX_ONLY=False,
+        DEBUG=False,
+        MESSAGE_DETAILS=False,
+        CONNECTIONS=args.connections,
+        COMPRESS=not args.no_compress,
+    )
+
+def write_config(path, values):
+    with open(path, 'w') as f:
+        for name, value in sorted(values.items()):
+            f.write('%s = %r\n' % (name, value))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Timer:
+    def __init__(self, results):
+        self.results = results
+
+    def __call__(self, name, messages):
+        self.name = name
+        self.messages = messages
+        return self
+
+    def __enter__(self):
+        print('%s...' % self.name, file=sys.stderr, flush=True)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.results[self.name] = dict(seconds=round(seconds, 4), messages=self.messages,
+            rate=round(self.messages / seconds, 1) if seconds > 0 else None)
+        print('%s: %.3fs' % (self.name, seconds), file=sys.stderr, flush=True)
+
+class CheckFailed(Exception):
+    """ a phase left different labels than the fake gmail has """
+
+def maildir_labels(maildir):
+    """ key => sorted labels of the messages in a Maildir, from their X-GMAIL-LABELS """
+    parser = email.parser.BytesHeaderParser()
+    labels = dict()
+    for subdir in ('cur', 'new'):
+        for name in os.listdir(os.path.join(maildir, subdir)):
+            with open(os.path.join(maildir, subdir, name), 'rb') as f:
+                value = parser.parse(f).get('X-GMAIL-LABELS', '')
+            # the ones not rewritten may still be RFC 2047 encoded
+            value = str(email.header.make_header(email.header.decode_header(value)))
+            labels[name.split(':')[0]] = sorted(gmailimap.split_labels(value))
+    return labels
+
+def check_maildir(phase, maildir, messages, skip=()):
+    """
+    raises CheckFailed unless every message in maildir has the labels it has
+    in messages, except the ones whose index is in skip
+    """
+    labels = maildir_labels(maildir)
+    wrong = []
+    for n, message in enumerate(messages):
+        key = '1500000000.M%dP0.bench' % n
+        if n not in skip and labels.get(key) != sorted(message['labels']):
+            wrong.append(key)
+    if len(wrong) > 0:
+        raise CheckFailed('%s: %d of %d messages have the wrong labels, e.g. %s'
+            % (phase, len(wrong), len(messages), ', '.join(wrong[:5])))
+
+def check_restored(phase, store, messages):
+    """
+    raises CheckFailed unless the account of store has the user labels of
+    messages added, merged by Message-ID like the restorer does
+    """
+    wanted = dict()
+    for message in messages:
+        if message['msgid'] != None:
+            wanted.setdefault(message['msgid'], set()).update(
+                label for label in message['labels'] if label not in synthetic.SYSTEM_LABELS)
+    wrong = []
+    for message, restored in zip(messages, store.messages):
+        want = set(label for label in message['labels'] if label in synthetic.SYSTEM_LABELS)
+        want.update(wanted.get(message['msgid'], ()))
+        if set(restored['labels']) != want:
+            wrong.append(str(restored['uid']))
+    if len(wrong) > 0:
+        raise CheckFailed('%s: %d of %d messages have the wrong labels, e.g. UIDs %s'
+            % (phase, len(wrong), len(messages), ', '.join(wrong[:5])))
+
+def run_script(script, *args, cwd=None, check=True):
+    subprocess.run([sys.executable, '-B', os.path.join(ROOT, script)] + list(args), cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=None if check else subprocess.DEVNULL, check=check)
+
+def bench_sync(args, workdir, timed):
+    """ the phases of gmail-sync-labels.py, one at a time, in this process """
+    messages = synthetic.generate(args.messages, args.seed, args.labels, args.missing_ids, args.duplicate_ids)
+    server = fakegmail.start(fakegmail.Store(messages, args.latency))
+    maildir = os.path.join(workdir, 'Maildir')
+    synthetic.write_maildir(maildir, messages, args.seed, args.changed, args.attachment_size, args.encoded_labels)
+
+    sync = importlib.machinery.SourceFileLoader('gmail_sync_labels', os.path.join(ROOT, 'gmail-sync-labels.py')).load_module()
+    sync.config = types.ModuleType('config')
+    sync.config.__dict__.update(config_values(args, maildir, server.server_address[1]))
+
+    db = sync.MaildirDatabase(maildir)
+    try:
+        with timed('init', args.messages):
+            for progress in db.init(args.jobs):
+                pass
+        with timed('init_cached', args.messages):
+            for progress in db.init(args.jobs):
+                pass
+        with timed('cache_message_info', args.messages):
+            db.cache_message_info()
+
+        async def download():
+            gmail = await sync.connect_gmail()
+            try:
+                await gmail.selectfolder(sync.config.IMAP_FOLDER)
+                last = await gmail.last_uid()
+                if args.connections > 1:
+                    labels = sync.download_labels_parallel(gmail, args.connections, sync.config.IMAP_FOLDER, last)
+                else:
+                    labels = sync.download_labels(gmail, last)
+                return [message async for message in labels if not isinstance(message, sync.FetchedRange)]
+            finally:
+                await gmail.logout()
+        with timed('download_labels', args.messages):
+            downloaded = asyncio.run(download())
+
+        counts = dict(total=len(downloaded), updated=0, checked=0, errors=0)
+        with timed('apply_labels', args.messages):
+            sync.apply_batch(db, downloaded, counts)
+        check_maildir('apply_labels', maildir, messages)
+    finally:
+        db.close()
+        server.shutdown()
+        server.server_close()
+
+    # the whole script, from a fresh Maildir, and then again with nothing changed
+    server = fakegmail.start(fakegmail.Store(messages, args.latency))
+    maildir = os.path.join(workdir, 'Maildir2')
+    synthetic.write_maildir(maildir, messages, args.seed, args.changed, args.attachment_size, args.encoded_labels)
+    cfg = os.path.join(workdir, 'sync_config.py')
+    write_config(cfg, config_values(args, maildir, server.server_address[1]))
+    try:
+        with timed('sync_end_to_end', args.messages):
+            run_script('gmail-sync-labels.py', '-j', str(args.jobs), cfg)
+        check_maildir('sync_end_to_end', maildir, messages)
+        with timed('sync_incremental', args.messages):
+            run_script('gmail-sync-labels.py', '-j', str(args.jobs), cfg)
+        check_maildir('sync_incremental', maildir, messages)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def bench_sync_modes(args, workdir, timed):
+    """ gmail-sync-labels.py with refusals and dropped connections, with --plan, and with a sidecar """
+    messages = synthetic.generate(args.messages, args.seed, args.labels, args.missing_ids, args.duplicate_ids)
+    store = fakegmail.Store(messages, args.latency)
+    server = fakegmail.start(store)
+    def setup(name, **values):
+        maildir = os.path.join(workdir, name)
+        synthetic.write_maildir(maildir, messages, args.seed, args.changed, args.attachment_size, args.encoded_labels)
+        cfg = os.path.join(workdir, name + '_config.py')
+        write_config(cfg, dict(config_values(args, maildir, server.server_address[1]), **values))
+        return maildir, cfg
+    try:
+        # a few messages gmail won't hand out, and the connection dropped
+        # part way, so the second run has to pick up the interrupted sweep
+        maildir, cfg = setup('Maildir-faults', CONNECTIONS=1)
+        refused = set(range(1, args.messages + 1, max(1, args.messages // 3)))
+        store.refuse = refused
+        store.drop_after = 3
+        with timed('sync_faults', args.messages):
+            run_script('gmail-sync-labels.py', cfg, check=False)
+            run_script('gmail-sync-labels.py', cfg)
+        check_maildir('sync_faults', maildir, messages, skip=set(seq - 1 for seq in refused))
+        # the refused ones are retried by the next incremental sync
+        store.refuse = set()
+        store.drop_after = None
+        with timed('sync_retry_refused', args.messages):
+            run_script('gmail-sync-labels.py', cfg)
+        check_maildir('sync_retry_refused', maildir, messages)
+
+        maildir, cfg = setup('Maildir-plan')
+        before = maildir_labels(maildir)
+        plan = os.path.join(workdir, 'labels.plan')
+        with timed('sync_plan', args.messages):
+            run_script('gmail-sync-labels.py', '--plan', plan, cfg)
+        if maildir_labels(maildir) != before:
+            raise CheckFailed('sync_plan: the Maildir was changed')
+        with timed('sync_apply_plan', args.messages):
+            run_script('gmail-sync-labels.py', '--apply-plan', plan, cfg)
+        check_maildir('sync_apply_plan', maildir, messages)
+
+        maildir, cfg = setup('Maildir-sidecar', LABEL_STORE='sidecar')
+        with timed('sync_sidecar', args.messages):
+            run_script('gmail-sync-labels.py', cfg)
+        with timed('export_labels', args.messages):
+            run_script('gmail-sync-labels.py', '--export-labels', cfg)
+        check_maildir('export_labels', maildir, messages)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def bench_restore(args, workdir, timed):
+    """ gmail-restore-labels.py from a labelled account to one without labels """
+    messages = synthetic.generate(args.messages, args.seed, args.labels, args.missing_ids, args.duplicate_ids)
+    old = fakegmail.start(fakegmail.Store(messages, args.latency))
+    stripped = [dict(m, labels=[l for l in m['labels'] if l in synthetic.SYSTEM_LABELS]) for m in messages]
+    new = fakegmail.start(fakegmail.Store(stripped, args.latency))
+    restoredir = os.path.join(workdir, 'restore')
+    os.makedirs(restoredir)
+    write_config(os.path.join(restoredir, 'old_config.py'), config_values(args, None, old.server_address[1]))
+    write_config(os.path.join(restoredir, 'new_config.py'), config_values(args, None, new.server_address[1]))
+    try:
+        with timed('restore_end_to_end', args.messages):
+            run_script('gmail-restore-labels.py', 'old_config.py', 'new_config.py', cwd=restoredir)
+        check_restored('restore_end_to_end', new.store, messages)
+        # the index is kept, so this is just the apply pass, with nothing left to do
+        with timed('restore_again', args.messages):
+            run_script('gmail-restore-labels.py', 'old_config.py', 'new_config.py', cwd=restoredir)
+        check_restored('restore_again', new.store, messages)
+
+        # from the index of a Maildir kept in sync with the old account, without downloading
+        maildir = os.path.join(workdir, 'Maildir3')
+        synthetic.write_maildir(maildir, messages, args.seed, args.changed, args.attachment_size, args.encoded_labels)
+        cfg = os.path.join(workdir, 'sync_config3.py')
+        write_config(cfg, config_values(args, maildir, old.server_address[1]))
+        run_script('gmail-sync-labels.py', '-j', str(args.jobs), cfg)
+        fresh = fakegmail.start(fakegmail.Store(stripped, args.latency))
+        restoredir = os.path.join(workdir, 'restore-maildir')
+        os.makedirs(restoredir)
+        write_config(os.path.join(restoredir, 'old_config.py'), config_values(args, maildir, None))
+        write_config(os.path.join(restoredir, 'new_config.py'), config_values(args, None, fresh.server_address[1]))
+        try:
+            with timed('restore_from_maildir', args.messages):
+                run_script('gmail-restore-labels.py', '--from-maildir', 'old_config.py', 'new_config.py', cwd=restoredir)
+            check_restored('restore_from_maildir', fresh.store, messages)
+        finally:
+            fresh.shutdown()
+            fresh.server_close()
+    finally:
+        for server in (old, new):
+            server.shutdown()
+            server.server_close()
+
+def compare(old, new):
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+    if old['parameters'] != new['parameters']:
+        print('warning: the runs used different parameters')
+    print('%-20s %10s %10s %8s' % ('phase', 'before', 'after', 'change'))
+    for phase in list(old['results']) + [p for p in new['results'] if p not in old['results']]:
+        before = old['results'].get(phase, {}).get('seconds')
+        after = new['results'].get(phase, {}).get('seconds')
+        change = '%+.1f%%' % ((after - before) * 100 / before) if before and after != None else ''
+        print('%-20s %10s %10s %8s' % (phase,
+            '%.3fs' % before if before != None else '-',
+            '%.3fs' % after if after != None else '-', change))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gmail-sync-labels.py and gmail-restore-labels.py against a fake gmail.')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--labels', type=int, default=20, help='number of user labels')
+    parser.add_argument('--missing-ids', type=float, default=0.01, help='fraction of messages without a Message-ID')
+    parser.add_argument('--duplicate-ids', type=float, default=0.01, help='fraction of messages reusing a Message-ID')
+    parser.add_argument('--changed', type=float, default=0.1, help='fraction of messages whose labels changed on the server')
+    parser.add_argument('--encoded-labels', type=float, default=0.1, help='fraction of messages with RFC 2047 encoded labels')
+    parser.add_argument('--attachment-size', type=int, default=0, help='bytes of attachment in every message')
+    parser.add_argument('--latency', type=float, default=0.0, help='round trip time of the fake server in seconds')
+    parser.add_argument('--connections', type=int, default=1)
+    parser.add_argument('--no-compress', action='store_true', help='don\'t use COMPRESS=DEFLATE')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--only', choices=['sync', 'restore'], help='run only one of the scripts\' benchmarks')
+    parser.add_argument('--keep', action='store_true', help='keep the generated files and print where they are')
+    parser.add_argument('--output', help='write the results to this JSON file as well as stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    parameters = dict((name, value) for name, value in vars(args).items()
+        if name not in ('only', 'keep', 'output', 'compare'))
+    results = dict()
+    timed = Timer(results)
+    workdir = tempfile.mkdtemp(prefix='gmail-sync-labels-bench-')
+    try:
+        if args.only in (None, 'sync'):
+            bench_sync(args, workdir, timed)
+            bench_sync_modes(args, workdir, timed)
+        if args.only in (None, 'restore'):
+            bench_restore(args, workdir, timed)
+    except CheckFailed as err:
+        # timings of a run that got the labels wrong are worthless
+        print('check failed: %s' % err, file=sys.stderr)
+        return 1
+    finally:
+        if args.keep:
+            print('files kept in %s' % workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+    report = dict(version=FORMAT_VERSION,
+        timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        commit=git_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        parameters=parameters,
+        results=results)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Synthetic mail for the benchmarks: the same seed always gives the same
+messages, so the fake server and the generated Maildir agree on them.
+"""
+
+import base64
+import email.header
+import os
+import random
+
+SYSTEM_LABELS = ['\\Inbox', '\\Important', '\\Sent', '\\Starred']
+
+def label_names(count):
+    # a few awkward ones, quoted by gmail, plus plain ones
+    return SYSTEM_LABELS + ['with space', 'paren)s'] + ['label%d' % i for i in range(count)]
+
+def quote_label(label):
+    """ label as gmail puts it in an X-GM-LABELS list """
+    if all(c.isalnum() or c in '_-./' for c in label) and label.isascii():
+        return label
+    return '"' + label.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def generate(count, seed=1, labels=20, missing_ids=0.0, duplicate_ids=0.0):
+    """
+    count messages as dicts of uid, gmailid, thrid, msgid (None if it has
+    none) and labels (what the server has)
+    """
+    rnd = random.Random(seed)
+    names = label_names(labels)
+    messages = []
+    for i in range(count):
+        if rnd.random() < missing_ids:
+            msgid = None
+        elif rnd.random() < duplicate_ids and i > 0:
+            # e.g. the same mail sent to a list and directly
+            msgid = messages[rnd.randrange(i)]['msgid']
+        else:
+            msgid = '<msg%d.%d@example.com>' % (i, seed)
+        messages.append(dict(uid=i * 2 + 1, gmailid=10**18 + i, thrid=10**18 + i // 3, msgid=msgid,
+            labels=sorted(set(rnd.sample(names, rnd.randint(0, 4))))))
+    return messages
+
+def write_maildir(path, messages, seed=1, changed=0.1, attachment_size=0, encoded_labels=0.1):
+    """
+    Writes messages into a new Maildir at path, the way getmail leaves them:
+    with X-GMAIL-* headers carrying the labels they had when downloaded.
+    A changed fraction of them have different labels than the server now,
+    and encoded_labels of them have the labels RFC 2047 encoded.
+    """
+    rnd = random.Random(seed + 1)
+    for sub in ('cur', 'new', 'tmp'):
+        os.makedirs(os.path.join(path, sub), exist_ok=True)
+    attachment = base64.encodebytes(rnd.randbytes(attachment_size) if hasattr(rnd, 'randbytes')
+        else os.urandom(attachment_size)) if attachment_size > 0 else b''
+    for n, message in enumerate(messages):
+        labels = message['labels']
+        if rnd.random() < changed:
+            labels = ['old%d' % rnd.randrange(5)]
+        labels = ' '.join(quote_label(label) for label in labels)
+        if rnd.random() < encoded_labels:
+            labels = email.header.Header(labels, 'utf-8').encode()
+
+        headers = [
+            'From: Sender %d <sender%d@example.com>' % (n % 97, n % 97),
+            'To: someone@example.com',
+            'Subject: %s' % email.header.Header('hello wörld %d' % n, 'utf-8').encode(),
+            'Date: Mon, 1 Jan 2018 00:00:00 +0000',
+        ]
+        if message['msgid'] != None:
+            headers.append('Message-ID: %s' % message['msgid'])
+        headers += [
+            'X-GMAIL-LABELS: %s' % labels,
+            'X-GMAIL-THRID: %d' % message['thrid'],
+            'X-GMAIL-MSGID: %d' % message['gmailid'],
+            'MIME-Version: 1.0',
+        ]
+        if attachment:
+            headers.append('Content-Type: multipart/mixed; boundary="b"')
+            body = ('--b\nContent-Type: text/plain\n\nmessage %d\n--b\n'
+                'Content-Type: application/octet-stream\nContent-Transfer-Encoding: base64\n\n' % n).encode() \
+                + attachment + b'--b--\n'
+        else:
+            headers.append('Content-Type: text/plain')
+            body = ('message %d\n' % n).encode() * 10
+        data = '\n'.join(headers).encode('utf-8') + b'\n\n' + body
+        with open(os.path.join(path, 'cur', '1500000000.M%dP0.bench:2,S' % n), 'wb') as f:
+            f.write(data)
@@ -3,173 +3,373 @@
 import importlib
 import importlib.machinery
 
+import argparse
+import array
+import asyncio
+import bisect
+import collections
 import email.header
-import imaplib
+import gmailimap
+import hashlib
+import json
+import mmap
 import os
 import pprint
-import re
 import shelve
-import ssl
 import pickle
+import sqlite3
+import struct
 import time
 import datetime
 
 oldconfig = None
 newconfig = None
 
-#FIXME: refactor to separate file to share code
-class Gmail(imaplib.IMAP4_SSL):
-    def __init__(self, cfg):
-        ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        ctx.verify_mode = ssl.CERT_REQUIRED
-        ctx.set_default_verify_paths()
-        # XXX: alternative, should work too:
-        # ctx.load_verify_locations('/etc/ssl/certs/ca-certificates.crt')
+# the version of the gmail-sync-labels.py index create_index_from_maildir reads
+SYNC_INDEX_VERSION = 5
 
-        imaplib.IMAP4_SSL.__init__(self, 'imap.gmail.com', 993, ssl_context=ctx)
+async def connect(cfg):
+    gmail = await gmailimap.Gmail.connect(cfg.LOGIN, cfg.PASSWORD,
+        getattr(cfg, 'IMAP_SERVER', 'imap.gmail.com'),
+        getattr(cfg, 'IMAP_PORT', 993),
+        getattr(cfg, 'IMAP_CA_FILE', None),
+        compress=getattr(cfg, 'COMPRESS', True))
+    return gmail
 
-        # XXX: I have no idea how to check / if I need to check that thing. State from 2012-12-14.
-        # MGL: set_default_verify_paths should do the work, as long as openssl is configured properly
-        # assert self.sock.getpeercert() == {'subject': ((('countryName', 'US'),), (('stateOrProvinceName', 'California'),), (('localityName', 'Mountain View'),), (('organizationName', 'Google Inc'),), (('commonName', 'imap.gmail.com'),)), 'serialNumber': '3B73268B0000000068A5', 'subjectAltName': (('DNS', 'imap.gmail.com'),), 'version': 3, 'notBefore': 'Sep 12 11:55:49 2012 GMT', 'notAfter': 'Jun  7 19:43:27 2013 GMT', 'issuer': ((('countryName', 'US'),), (('organizationName', 'Google Inc'),), (('commonName', 'Google Internet Authority'),))}
+async def download_labels_batch(response, labelsets=None):
+    # messages without a Message-ID come back with msgid None
+    if labelsets != None:
+        return [(message.uid, message.msgid, labelsets.get(message.uid, '')) async for message in response]
+    return [(message.uid, message.msgid, message.labels) async for message in response]
 
-        self.login(cfg.LOGIN, cfg.PASSWORD)
+async def download_labels_batches(gmail, last, first=1, labelsets=None):
+    """
+    yields (last UID covered, messages) for UID ranges from first to last;
+    given labelsets, a dict of UID => labels from Gmail.label_sets, only the
+    Message-IDs are fetched and the labels taken from there
+    """
+    batch_size = 1000
+    # keep the next couple of batches on their way while one is handled
+    depth = 2
+    responses = collections.deque()
+    for start in range(first, last + 1, batch_size):
+        # for 1,100 ask for 1:100, next time 101:200, etc.
+        end = min(last, start + batch_size - 1)
+        if labelsets != None:
+            responses.append((end, gmail.fetch_ids('%d:%d' % (start, end), uid=True, msgid=True)))
+        else:
+            responses.append((end, gmail.fetch_labels('%d:%d' % (start, end), uid=True)))
+        if len(responses) > depth:
+            end, response = responses.popleft()
+            yield end, await download_labels_batch(response, labelsets)
+    while len(responses) > 0:
+        end, response = responses.popleft()
+        yield end, await download_labels_batch(response, labelsets)
 
-        assert 'X-GM-EXT-1' in self.capabilities
-        
-        # set a timeout for further ops so that it doesn't hang on network hiccups
-        self.socket().settimeout(30.0)
+async def download_labels(gmail, last, labelsets=None):
+    async for end, batch in download_labels_batches(gmail, last, labelsets=labelsets):
+        for uid, msgid, labels in batch:
+            yield uid, msgid, labels
 
-    def selectfolder(self, folder, readonly=True):
-        resp = self.select(folder, readonly)
-        assert resp[0] == 'OK'
+async def search_labels(gmail, cfg, total):
+    """
+    UID => labels of the messages with user labels, from a search per label,
+    if LABEL_STRATEGY says so, otherwise None to fetch them with each message
+    """
+    strategy = getattr(cfg, 'LABEL_STRATEGY', 'auto')
+    if strategy == 'fetch':
+        return None
+    # the system labels aren't restored anyway
+    labels = [label for label in await gmail.list_labels() if label[0:1] != '\\']
+    if strategy == 'auto' and len(labels) * gmailimap.SEARCH_MESSAGES_PER_LABEL > total:
+        return None
+    print('Searching %d labels' % len(labels))
+    return await gmail.label_sets(labels)
 
-        total = int(resp[1][0])
-        assert total > 0
+def uid_set(uids):
+    """ compact imap message set for some uids, e.g. 1:3,7,9:10 """
+    ranges = []
+    for uid in sorted(int(uid) for uid in uids):
+        if len(ranges) > 0 and ranges[-1][1] + 1 == uid:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join('%d' % first if first == last else '%d:%d' % (first, last) for first, last in ranges)
 
-        return total
+def map_labels(labels):
+    for label in gmailimap.split_labels(labels):
+        #TODO: could keep most of these and map to things under [Gmail]/
+        if label[0:1] == '\\':
+            continue
+        yield label
 
-#FIXME: refactor to separate class to share code
-def download_labels_batch(gmail, start, count):
-    # for 1,100 ask for 1:100, next time 101:200, etc.
-    resp = gmail.fetch('%d:%d' % (start, start + count - 1), '(X-GM-LABELS UID BODY[HEADER.FIELDS (MESSAGE-ID)])')
+def message_id_hash(msgid):
+    # 64 bits is plenty, a collision would just merge two messages' labels
+    return int.from_bytes(hashlib.blake2b(msgid.encode('utf-8', 'surrogateescape'), digest_size=8).digest(), 'little')
 
-    assert resp[0] == 'OK'
+class LabelIndexBuilder:
+    """ collects Message-ID => labels, interning the labels and label sets as it goes """
+    def __init__(self):
+        # label => label id
+        self.labels = dict()
+        # tuple of label ids => set id, and the other way around
+        self.sets = dict()
+        self.setlabels = []
+        # Message-ID hash => set id
+        self.messages = dict()
 
-    """
-    response here is ugly:
-
-    [(b'1 (X-GM-LABELS () UID 1 BODY[HEADER.FIELDS (MESSAGE-ID)] {61}',
-      b'Message-ID: <a38097d40612071225s1e399c3eu@mail.gmail.com>\r\n\r\n'),
-     b')',
-     (b'2 (X-GM-LABELS () UID 2 BODY[HEADER.FIELDS (MESSAGE-ID)] {40}',
-      b'Message-ID: <45787AFA.7020202@wp.pl>\r\n\r\n'),
-     b')',
-     ...
-    ]
-    
-    And UID comes after X-GM-LABELs regardless of request order, wtf?
-    """
-    regexp = re.compile('(\d+) \(X-GM-LABELS \((.*)\) UID (\d+) BODY\[HEADER.FIELDS \(MESSAGE-ID\)\] {(\d+)}')
+    def add(self, msgid, labels):
+        # messages without a Message-ID can't be matched up later anyway
+        if msgid == None:
+            return
+        labelids = set(self.labels.setdefault(label, len(self.labels)) for label in labels)
+        h = message_id_hash(msgid)
+        # the same Message-ID can be on several messages, merge their labels
+        if h in self.messages:
+            labelids.update(self.setlabels[self.messages[h]])
+        labelids = tuple(sorted(labelids))
+        setid = self.sets.setdefault(labelids, len(self.sets))
+        if setid == len(self.setlabels):
+            self.setlabels.append(labelids)
+        self.messages[h] = setid
 
-    # every even (2, 4, 6, 8, ...) item from response should be b')'
-    for even_item in resp[1][1::2]:
-        assert even_item == b')'
+    def write(self, path):
+        """
+        File layout, in native byte order:
 
-    # every odd (1, 3, 5, 7, ...) item should match regexp
-    for odd_item in resp[1][::2]:
-        try:
-            imapid, labels, uid, payloadlen = regexp.match(odd_item[0].decode('utf-8')).groups()
-        except AttributeError:
-            print("%s\n%s" % (odd_item[0], odd_item[1]))
-            raise
+          header:     magic, byte order mark, number of labels, sets and messages
+          labels:     (length, utf-8 bytes) for each label id
+          setoffsets: where each set id's label ids start in setlabels, 8 byte aligned
+          setlabels:  the label ids of all the sets
+          hashes:     sorted Message-ID hashes, 8 byte aligned
+          setids:     the set id for each hash
+        """
+        labels = sorted(self.labels, key=self.labels.get)
+        data = bytearray(struct.pack(LabelIndex.HEADER, LabelIndex.MAGIC, LabelIndex.BOM,
+            len(labels), len(self.setlabels), len(self.messages)))
+        for label in labels:
+            encoded = label.encode('utf-8', 'surrogateescape')
+            data += struct.pack('=H', len(encoded)) + encoded
+        data += bytes(-len(data) % 8)
+        setoffsets = array.array('I', [0])
+        setlabels = array.array('H')
+        for labelids in self.setlabels:
+            setlabels.extend(labelids)
+            setoffsets.append(len(setlabels))
+        data += setoffsets.tobytes() + setlabels.tobytes()
+        data += bytes(-len(data) % 8)
+        hashes = sorted(self.messages)
+        data += array.array('Q', hashes).tobytes()
+        data += array.array('I', (self.messages[h] for h in hashes)).tobytes()
+        # write then rename, so a crash never leaves a truncated index behind
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
 
-        assert int(payloadlen) == len(odd_item[1])
+class LabelIndex:
+    """ Message-ID => labels lookups straight out of a memory mapped file, see LabelIndexBuilder.write """
+    MAGIC = b'GRLIDX02'
+    BOM = 0x01020304
+    HEADER = '=8sIIIQ'
 
-        try:
-            msgid = odd_item[1].decode('utf-8').split()[1]
-        except IndexError:
-            if config.DEBUG or config.MESSAGE_DETAILS:
-                print('got message without Message-ID header: '
-                      'gmail id %s, link: https://mail.google.com/mail/#all/%s'
-                      % (gmailid, hex(int(gmailthreadid))[2:])
-                )
-            #continue
-            # allow update by gmail id
-            msgid = None
-
-        yield uid, msgid, labels
-
-#FIXME: refactor to separate class to share code
-def download_labels(gmail, total):
-    batch_size = 1000
-    for start in range(1, total, batch_size):
-        for uid, msgid, labels in download_labels_batch(gmail, start, batch_size):
-            yield uid, msgid, labels
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bom, nlabels, nsets, nmessages = struct.unpack_from(self.HEADER, self.__map)
+        if magic != self.MAGIC or bom != self.BOM:
+            raise ValueError('%s is not a label index for this machine, remove it to rebuild' % path)
+        offset = struct.calcsize(self.HEADER)
+        # there are only so many different labels, decode them right away
+        self.__labels = []
+        for n in range(nlabels):
+            length, = struct.unpack_from('=H', self.__map, offset)
+            self.__labels.append(self.__map[offset + 2:offset + 2 + length].decode('utf-8', 'surrogateescape'))
+            offset += 2 + length
+        offset += -offset % 8
+        view = memoryview(self.__map)
+        self.__setoffsets = view[offset:offset + 4 * (nsets + 1)].cast('I')
+        offset += 4 * (nsets + 1)
+        self.__setlabels = view[offset:offset + 2 * self.__setoffsets[nsets]].cast('H')
+        offset += 2 * self.__setoffsets[nsets]
+        offset += -offset % 8
+        self.__hashes = view[offset:offset + 8 * nmessages].cast('Q')
+        offset += 8 * nmessages
+        self.__setids = view[offset:offset + 4 * nmessages].cast('I')
+        # label sets are decoded when first needed, and shared after that
+        self.__sets = dict()
 
-def map_labels(labels):
-    for label in labels.split():
-        #TODO: could keep most of these and map to things under [Gmail]/
-        if label[0:3] == '"\\\\':
-            assert label[-1:] == '"'
-            continue
-        yield label
+    def __len__(self):
+        return len(self.__hashes)
+
+    def get(self, msgid, default=None):
+        if msgid == None:
+            return default
+        h = message_id_hash(msgid)
+        n = bisect.bisect_left(self.__hashes, h)
+        if n == len(self.__hashes) or self.__hashes[n] != h:
+            return default
+        setid = self.__setids[n]
+        labels = self.__sets.get(setid)
+        if labels == None:
+            labelids = self.__setlabels[self.__setoffsets[setid]:self.__setoffsets[setid + 1]]
+            labels = self.__sets[setid] = frozenset(self.__labels[labelid] for labelid in labelids)
+        return labels
 
-def create_label_index(gmail, cfg):
-    total = gmail.selectfolder(cfg.IMAP_FOLDER)
-    index = dict()
+async def create_label_index(gmail, cfg):
+    total = await gmail.selectfolder(cfg.IMAP_FOLDER)
+    index = LabelIndexBuilder()
     count = 0
-    for uid, msgid, labels in download_labels(gmail, total):
-        msglabels = index.setdefault(msgid, set())
-        msglabels.update(map_labels(labels))
+    labelsets = await search_labels(gmail, cfg, total)
+    async for uid, msgid, labels in download_labels(gmail, await gmail.last_uid(), labelsets):
+        index.add(msgid, map_labels(labels))
         count += 1
         if count % 100 == 0:
             print("Fetch: %7d / %7d" % (count, total), end='\r', flush=True)
     print("Fetch: %7d / %7d -- Done" % (count, total))
     return index
 
-def apply_labels(gmail, cfg, index):
-    total = gmail.selectfolder(cfg.IMAP_FOLDER)
+class Checkpoint:
+    """
+    How far applying labels got, in a small file next to the label index,
+    so an interrupted restore carries on from there.  Only good for the
+    same account, folder and UIDVALIDITY.
+    """
+    def __init__(self, path, cfg, uidvalidity):
+        self.path = path
+        self.key = dict(login=cfg.LOGIN, folder=cfg.IMAP_FOLDER, uidvalidity=uidvalidity)
+
+    def load(self):
+        """ the last UID everything up to was done for, 0 if none """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if state.get('key') != self.key:
+            return 0
+        return state['done']
+
+    def save(self, done):
+        # write then rename, a crash mid-write must not lose the old one
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(dict(key=self.key, done=done), f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+async def apply_labels(gmail, cfg, index, checkpointfile):
+    total = await gmail.selectfolder(cfg.IMAP_FOLDER)
+    checkpoint = Checkpoint(checkpointfile, cfg, gmail.uidvalidity)
+    done = checkpoint.load()
+    if done > 0:
+        print('Resuming after UID %d' % done)
     count = 0
     modified = 0
     added = 0
+    commands = 0
     start = time.time()
-    for uid, msgid, labels in download_labels(gmail, total):
-        count += 1
-        msgwantlabels = index.get(msgid, set())
-        if len(msgwantlabels) == 0:
-            print("No labels for %s" % msgid)
-        msghaslabels = set(map_labels(labels))
-        msgneedlabels = msgwantlabels - msghaslabels
-        if len(msgneedlabels) != 0:
-            modified += 1
-        #print("Message %s has %s, should have %s, add %s" % (msgid, msghaslabels, msgwantlabels, msgneedlabels))
-        for l in msgneedlabels:
-            type, data = gmail.uid('COPY', uid, l)
+    async for end, batch in download_labels_batches(gmail, await gmail.last_uid(), done + 1):
+        # label => uids of the messages in this batch missing it
+        needlabels = dict()
+        for uid, msgid, labels in batch:
+            count += 1
+            msgwantlabels = index.get(msgid, set())
+            if len(msgwantlabels) == 0:
+                print("No labels for %s" % msgid)
+            msghaslabels = set(map_labels(labels))
+            msgneedlabels = msgwantlabels - msghaslabels
+            if len(msgneedlabels) != 0:
+                modified += 1
+            #print("Message %s has %s, should have %s, add %s" % (msgid, msghaslabels, msgwantlabels, msgneedlabels))
+            for l in msgneedlabels:
+                needlabels.setdefault(l, []).append(uid)
+        # copying to a label's folder adds the label, do the whole batch at once,
+        # with all the copies in flight together
+        copies = [gmail.send('UID', 'COPY', uid_set(uids), gmailimap.quote_label(l)) for l, uids in needlabels.items()]
+        for type, data in await asyncio.gather(*copies):
             assert type == 'OK'
-            added += 1
             #print("%s" % (data,))
-        # apply is slow, print all the time
-        if True or count % 100 == 0:
-            remaining = total - count
-            if remaining <= 0:
-            	# wtf?
-            	remaining = 0
-            now = time.time()
-            if modified != 0:
-                eta = start + (now - start) * remaining / modified
-                assert eta >= start, "%f %f %d %d %d %d" % (start, now, total, count, remaining, modified)
-                etastring = datetime.datetime.fromtimestamp(eta).strftime('%Y-%m-%d %H:%M:%S')
-            else:
-                etastring = '?'
-            print("Apply: %7d (%8d) / %7d ETA %s" % (count, added, total, etastring), end='\r', flush=True)
+        added += sum(len(uids) for uids in needlabels.values())
+        commands += len(copies)
+        # batches are handled in order, so everything up to here is done
+        checkpoint.save(end)
+        remaining = total - count
+        if remaining <= 0:
+        	# wtf?
+        	remaining = 0
+        now = time.time()
+        if modified != 0:
+            eta = now + (now - start) * remaining / count
+            etastring = datetime.datetime.fromtimestamp(eta).strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            etastring = '?'
+        print("Apply: %7d (%8d) / %7d ETA %s" % (count, added, total, etastring), end='\r', flush=True)
     print("Apply: %7d (%8d) / %7d -- Done" % (count, added, total))
+    print("Sent %d COPY commands for %d label additions, saved %d round trips" % (commands, added, added - commands))
+    checkpoint.remove()
+
+def create_index_from_maildir(maildir):
+    """
+    LabelIndexBuilder out of the index gmail-sync-labels.py keeps in maildir,
+    without going near gmail, so only as up to date as the last sync there.
+    The index is read one row at a time, the message files aren't touched.
+    """
+    path = os.path.join(maildir, 'gmail-sync-labels.sqlite')
+    if not os.path.exists(path):
+        raise ValueError('%s not found, run gmail-sync-labels.py on %s first' % (path, maildir))
+    db = sqlite3.connect(path)
+    try:
+        tables = set(name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        version = db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone() if 'meta' in tables else None
+        if version == None or version[0] != SYNC_INDEX_VERSION:
+            raise ValueError('%s is not an index this version can read, run gmail-sync-labels.py on %s first' % (path, maildir))
+        sweep = db.execute("SELECT value FROM meta WHERE name = 'sweep_folder'").fetchone()
+        if sweep != None and sweep[0] != None:
+            print('Warning: the last full sync of %s did not finish, some labels may be out of date' % maildir)
+        total, = db.execute('SELECT COUNT(*) FROM message_ids').fetchone()
+        # labels not written to the files yet are in the sidecar
+        if 'sidecar' in tables:
+            query = '''SELECT message_ids.messageid, COALESCE(sidecar.labels, messages.labels)
+                FROM message_ids JOIN messages USING (key) LEFT JOIN sidecar USING (key)'''
+        else:
+            query = 'SELECT message_ids.messageid, messages.labels FROM message_ids JOIN messages USING (key)'
+        index = LabelIndexBuilder()
+        count = 0
+        for msgid, labels in db.execute(query):
+            if labels != None:
+                # as getmail wrote them, maybe RFC 2047 encoded
+                labels = str(email.header.make_header(email.header.decode_header(labels)))
+                index.add(msgid, map_labels(labels))
+            count += 1
+            if count % 1000 == 0:
+                print("Index: %7d / %7d" % (count, total), end='\r', flush=True)
+        print("Index: %7d / %7d -- Done" % (count, total))
+        return index
+    finally:
+        db.close()
+
+async def create_index_from(cfg):
+    async with await connect(cfg) as gmail:
+        return await create_label_index(gmail, cfg)
+
+async def apply_labels_to(cfg, index, checkpointfile):
+    async with await connect(cfg) as gmail:
+        await apply_labels(gmail, cfg, index, checkpointfile)
 
 oldconfig = None
 newconfig = None
 
 def main():
-    oldcfgname = sys.argv[1]
-    newcfgname = sys.argv[2]
+    parser = argparse.ArgumentParser(description='Copy the labels of one gmail account to another, by Message-ID.')
+    parser.add_argument('oldconfig', help='config module name or file of the account to copy from')
+    parser.add_argument('newconfig', help='config module name or file of the account to copy to')
+    parser.add_argument('--from-maildir', action='store_true',
+        help='take the labels from the index gmail-sync-labels.py keeps in the old config\'s MAILDIR, instead of downloading them')
+    args = parser.parse_args()
+    oldcfgname = args.oldconfig
+    newcfgname = args.newconfig
 
     global oldconfig
     global newconfig
@@ -182,22 +382,29 @@ def main():
     else:
     	newconfig = importlib.import_module(newcfgname)
 
-    labelsfile = 'gmail-restore-labels.labels.pickle'
-    index = None
-    try:
-        with open(labelsfile, 'rb') as f:
-            index = pickle.load(f)
-    except FileNotFoundError:
-        print('No index file, will generate one')
-        index = None
-    if index is None:
-        with Gmail(oldconfig) as oldgmail:
-            index = create_label_index(oldgmail, oldconfig)
-        with open(labelsfile, 'wb') as f:
-            pickle.dump(index, f)
+    labelsfile = 'gmail-restore-labels.labels.index'
+    picklefile = 'gmail-restore-labels.labels.pickle'
+    if not os.path.exists(labelsfile):
+        if os.path.exists(picklefile):
+            print('Converting %s to %s' % (picklefile, labelsfile))
+            with open(picklefile, 'rb') as f:
+                oldindex = pickle.load(f)
+            builder = LabelIndexBuilder()
+            for msgid, labels in oldindex.items():
+                # these kept the labels as gmail quoted them
+                builder.add(msgid, map_labels(' '.join(labels)))
+            del oldindex
+        elif args.from_maildir:
+            print('No index file, will generate one from %s' % oldconfig.MAILDIR)
+            builder = create_index_from_maildir(oldconfig.MAILDIR)
+        else:
+            print('No index file, will generate one')
+            builder = asyncio.run(create_index_from(oldconfig))
+        builder.write(labelsfile)
+        del builder
+    index = LabelIndex(labelsfile)
     
-    with Gmail(newconfig) as newgmail:
-        apply_labels(newgmail, newconfig, index)
+    asyncio.run(apply_labels_to(newconfig, index, 'gmail-restore-labels.checkpoint'))
     
     return
 
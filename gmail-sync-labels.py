@@ -10,23 +10,42 @@ The above copyright notice and this permission notice shall be included in all c
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import dbm
 import importlib
 import importlib.machinery
+import json
 
 import email.header
+import email.parser
+import gmailimap
 import imaplib
+import io
 import mailbox
+import multiprocessing
 import os
 import pprint
 import re
 import shelve
-import ssl
+import shutil
+import signal
+import sqlite3
+import stat
 import sys
+import threading
+import time
 
 # prep global for later init
 config = None
 
-DATA_VERSION = 4
+DATA_VERSION = 5
 
 # utility helper
 # GMail has started returning many headers with utf-8 encoding
@@ -43,375 +62,1871 @@ def header_to_string(headervalue):
             raise
     return str(header)
 
-#FIXME: refactor to separate file to share code
-class Gmail(imaplib.IMAP4_SSL):
-    def __init__(self, login, password):
-        ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        ctx.verify_mode = ssl.CERT_REQUIRED
-        ctx.set_default_verify_paths()
-        # XXX: alternative, should work too:
-        # ctx.load_verify_locations('/etc/ssl/certs/ca-certificates.crt')
+# message ids can have comments, extract just the <id@id> part
+# this is not perfect, comments might have strings that look like message ids
+# would need a full BNF parser for the productions in RFC2822 to handle this exactly right
+# need this because message ids gmail returns on queries have the comments stripped off
+extractmsgid = re.compile('.*?(<.*>).*')
 
-        imaplib.IMAP4_SSL.__init__(self, 'imap.gmail.com', 993, ssl_context=ctx)
+def read_header_block(f):
+    """ the raw header lines of a message file and the empty line ending them (b'' if none) """
+    lines = []
+    for line in f:
+        # the headers end at the first empty line
+        if line == b'\n' or line == b'\r\n':
+            return lines, line
+        lines.append(line)
+    return lines, b''
 
-        # XXX: I have no idea how to check / if I need to check that thing. State from 2012-12-14.
-        # MGL: set_default_verify_paths should do the work, as long as openssl is configured properly
-        # assert self.sock.getpeercert() == {'subject': ((('countryName', 'US'),), (('stateOrProvinceName', 'California'),), (('localityName', 'Mountain View'),), (('organizationName', 'Google Inc'),), (('commonName', 'imap.gmail.com'),)), 'serialNumber': '3B73268B0000000068A5', 'subjectAltName': (('DNS', 'imap.gmail.com'),), 'version': 3, 'notBefore': 'Sep 12 11:55:49 2012 GMT', 'notAfter': 'Jun  7 19:43:27 2013 GMT', 'issuer': ((('countryName', 'US'),), (('organizationName', 'Google Inc'),), (('commonName', 'Google Internet Authority'),))}
+def read_message_headers(path):
+    """ parse just the header block of a message file, without touching the body """
+    with open(path, 'rb') as f:
+        lines, end = read_header_block(f)
+    # same parser, policy and newline translation mailbox uses,
+    # so the values come out identical
+    return email.parser.BytesHeaderParser().parse(io.BytesIO(b''.join(lines)))
 
-        self.login(login, password)
+def header_labels(value):
+    # labels may have been padded with spaces to leave room for in place updates
+    if value == None:
+        return None
+    return value.rstrip(' ')
 
-        assert 'X-GM-EXT-1' in self.capabilities
+def same_labels(a, b):
+    """ whether two X-GM-LABELS texts have the same labels, maybe in another order or quoted differently """
+    if a == b:
+        return True
+    if a == None or b == None:
+        return False
+    return sorted(gmailimap.split_labels(a)) == sorted(gmailimap.split_labels(b))
 
-        self.__message_from_imapid_re = re.compile('(\d+) \(X-GM-MSGID (\d+) X-GM-THRID (\d+) X-GM-LABELS \((.*)\) RFC822 {(\d+)}')
+def labels_hash(labels):
+    """
+    hash of an X-GM-LABELS text for the lookup tables, 0 for None; only
+    good within one run, str hashes change from one process to the next
+    """
+    if labels == None:
+        return 0
+    return hash(labels) or 1
 
-    def selectfolder(self, folder, readonly=True):
-        resp = self.select(folder, readonly)
-        assert resp[0] == 'OK'
+def find_sorted(keys, key):
+    """ position of key in the sorted array keys, or None """
+    n = bisect.bisect_left(keys, key)
+    if n == len(keys) or keys[n] != key:
+        return None
+    return n
 
-        total = int(resp[1][0])
-        assert total > 0
+def copy_file_data(src, dst, offset):
+    """ append everything from offset in src to dst, inside the kernel where possible """
+    dst.flush()
+    size = os.fstat(src.fileno()).st_size
+    try:
+        while offset < size:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except (AttributeError, OSError):
+        # older python or kernel, or a filesystem that can't do it
+        pass
+    try:
+        while offset < size:
+            copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except (AttributeError, OSError):
+        pass
+    src.seek(offset)
+    dst.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dst)
 
-        return total
+def split_header_fields(lines):
+    """ group raw header lines into fields, joining the continuation lines """
+    fields = []
+    for line in lines:
+        if fields and line[:1] in (b' ', b'\t'):
+            fields[-1].append(line)
+        else:
+            fields.append([line])
+    return fields
 
-    # dead code?
-    def listmessages(self, folder):
-        print(' .. selecting mailbox')
-        total = self.selectfolder(folder)
+def message_index_info(message):
+    """ the index entry for a message: its Message-ID(s), gmail ids and labels """
+    messageids = []
+    gmailid = None
+    threadid = None
+    for k, v in message.items():
+        ku = k.upper()
+        # don't decode every header, both for performance
+        # and to avoid getting stuck on bogusly encoded headers
+        # that we don't care about to begin with
+        if ku == 'MESSAGE-ID':
+            vv = header_to_string(v)
+            idx = extractmsgid.match(vv)
+            if idx == None:
+                # bogus looking message id, track it as-is
+                messageids.append(vv)
+            else:
+                messageids.append(idx.groups()[0])
+        elif ku == 'X-GMAIL-MSGID':
+            # gmailid should never be duplicated
+            assert(gmailid == None)
+            vv = header_to_string(v)
+            gmailid = vv
+        elif ku == 'X-GMAIL-THRID' and threadid == None:
+            threadid = header_to_string(v)
+    # compared as-is against what gmail sends, so don't decode this one
+    labels = header_labels(message['X-GMAIL-LABELS'])
+    return { 'Message-ID': messageids, 'X-GMAIL-MSGID': gmailid, 'X-GMAIL-THRID': threadid, 'X-GMAIL-LABELS': labels }
 
-        print(' .. fetching remote index')
-        resp = self.fetch('1:%d' % total, '(X-GM-MSGID)')
+def index_messages(batch):
+    """ index a batch of (key, path) pairs, for running in a worker process """
+    return [(key, message_index_info(read_message_headers(path))) for key, path in batch]
 
-        assert resp[0] == 'OK'
-        msglist = resp[1]
+class Metrics:
+    """
+    Where a run spent its time and what it did: wall and CPU time per phase,
+    counters, the fetched chunks, and the traffic of the gmail sessions.
+    Written as JSON and as a Prometheus textfile (for node_exporter's
+    textfile collector), see METRICS_JSON and METRICS_PROMETHEUS.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        # name => [wall seconds, cpu seconds, times entered]
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        # (first, last, seconds, bytes) of each fetched range
+        self.chunks = []
+        # gmail connections, their byte counts are read when a snapshot is taken
+        self.sessions = []
+        # phases run in the writer thread too
+        self.__lock = threading.Lock()
+        self.__writing = threading.Lock()
+        self.__timer = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # cpu time of the thread doing the phase, index workers aren't counted
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            with self.__lock:
+                totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+                totals[0] += wall
+                totals[1] += cpu
+                totals[2] += 1
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.counters[name] += n
+
+    def chunk(self, chunk, seconds, size):
+        with self.__lock:
+            self.chunks.append((chunk[0], chunk[1], seconds, size))
+
+    def snapshot(self):
+        with self.__lock:
+            counters = dict(self.counters)
+            for name in ('bytes_sent', 'bytes_received', 'raw_bytes_sent', 'raw_bytes_received', 'commands'):
+                counters['imap_' + name] = sum(getattr(session, name) for session in self.sessions)
+            counters['imap_compressed_connections'] = sum(session.compressed for session in self.sessions)
+            counters['imap_connections'] = len(self.sessions)
+            return {
+                'started': self.started,
+                'elapsed': (self.finished or time.time()) - self.started,
+                'finished': self.finished != None,
+                'phases': dict((name, {'seconds': wall, 'cpu_seconds': cpu, 'count': n})
+                    for name, (wall, cpu, n) in self.phases.items()),
+                'counters': counters,
+                'fetch_chunks': [{'first': first, 'last': last, 'seconds': seconds, 'bytes': size}
+                    for first, last, seconds, size in self.chunks],
+            }
+
+    def prometheus(self, snapshot):
+        lines = []
+        def metric(name, help, samples):
+            lines.append('# HELP gmail_sync_labels_%s %s' % (name, help))
+            lines.append('# TYPE gmail_sync_labels_%s gauge' % name)
+            for labels, value in samples:
+                lines.append('gmail_sync_labels_%s%s %s' % (name, labels, repr(float(value))))
+        metric('started_timestamp_seconds', 'When the run started.', [('', snapshot['started'])])
+        metric('elapsed_seconds', 'How long the run took, so far if still running.', [('', snapshot['elapsed'])])
+        metric('running', '1 while the run is in progress.', [('', 0 if snapshot['finished'] else 1)])
+        for field, name, help in (('seconds', 'phase_seconds', 'Wall clock time spent in each phase.'),
+                ('cpu_seconds', 'phase_cpu_seconds', 'CPU time spent in each phase.'),
+                ('count', 'phase_runs', 'Times each phase was entered.')):
+            metric(name, help, [('{phase="%s"}' % phase, values[field]) for phase, values in snapshot['phases'].items()])
+        for name, value in sorted(snapshot['counters'].items()):
+            metric(name, 'Counter %s of the run.' % name, [('', value)])
+        chunks = snapshot['fetch_chunks']
+        metric('fetch_chunks', 'Ranges fetched.', [('', len(chunks))])
+        metric('fetch_chunk_seconds_sum', 'Time spent fetching ranges.', [('', sum(c['seconds'] for c in chunks))])
+        metric('fetch_chunk_seconds_max', 'Slowest range fetched.', [('', max([c['seconds'] for c in chunks] + [0]))])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """ writes the configured files, each replaced in one go so readers never see half of one """
+        jsonpath = getattr(config, 'METRICS_JSON', None)
+        prompath = getattr(config, 'METRICS_PROMETHEUS', None)
+        if jsonpath == None and prompath == None:
+            return
+        snapshot = self.snapshot()
+        with self.__writing:
+            for path, text in ((jsonpath, lambda: json.dumps(snapshot, indent=2, sort_keys=True) + '\n'),
+                    (prompath, lambda: self.prometheus(snapshot))):
+                if path != None:
+                    with open(path + '.tmp', 'w') as f:
+                        f.write(text())
+                    os.replace(path + '.tmp', path)
 
-        headersexp = re.compile('(\d+) \(X-GM-MSGID (\d+)\)')
+    def start(self):
+        """ writes a snapshot every METRICS_INTERVAL seconds until finish() """
+        interval = getattr(config, 'METRICS_INTERVAL', 0)
+        if interval <= 0:
+            return
+        self.__timer = threading.Event()
+        def run():
+            while not self.__timer.wait(interval):
+                self.write()
+        # with the config of the account it is for, see sync_accounts
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
 
-        print(' .. done')
-        for msg in msglist:
-            imapid, gmailid = headersexp.match(msg.decode('utf-8')).groups()
+    def finish(self):
+        if self.__timer != None:
+            self.__timer.set()
+        self.finished = time.time()
+        self.write()
 
-            yield int(imapid), int(gmailid)
+# filled in as the run goes along
+metrics = Metrics()
 
-    # dead code?
-    def message_from_imapid(self, imapid):
-        resp = self.fetch('%d' % imapid, '(X-GM-MSGID X-GM-THRID X-GM-LABELS RFC822)')
+# when syncing several accounts, config and metrics are ContextProxy objects
+# reading these, and each account runs in a context of its own
+current_account = contextvars.ContextVar('current_account', default=None)
+current_config = contextvars.ContextVar('current_config')
+current_metrics = contextvars.ContextVar('current_metrics')
 
-        assert resp[0] == 'OK'
-        assert resp[1][1] == b')'
+class ContextProxy:
+    """ stands in for a global that has a value per account, the one in var """
+    def __init__(self, var):
+        self.__var = var
 
-        imapid, msgid, thrid, labels, msglen = self.__message_from_imapid_re.match(resp[1][0][0].decode('utf-8')).groups()
+    def __getattr__(self, name):
+        return getattr(self.__var.get(), name)
 
-        assert int(msglen) == len(resp[1][0][1])
+class AccountOutput:
+    """
+    stdout while syncing several accounts: whole lines, each prefixed with
+    the account it is about, and no progress lines (the ones ending in \\r)
+    """
+    def __init__(self, out):
+        self.out = out
+        self.__lock = threading.Lock()
+        # account => the start of a line written so far
+        self.__partial = dict()
 
-        mail = email.message_from_bytes(resp[1][0][1])
-        # gmail/getmail returns the mail header spelled a bit different
-        mail.add_header('X-GMAIL-MSGID', msgid)
-        mail.add_header('X-GMAIL-THRID', thrid)
-        mail.add_header('X-GMAIL-LABELS', labels)
+    def write(self, text):
+        account = current_account.get()
+        with self.__lock:
+            lines = (self.__partial.pop(account, '') + text).split('\n')
+            for line in lines[:-1]:
+                line = line.rpartition('\r')[2]
+                if line != '':
+                    self.out.write(line + '\n' if account == None else '[%s] %s\n' % (account, line))
+            if lines[-1].rpartition('\r')[2] != '':
+                self.__partial[account] = lines[-1].rpartition('\r')[2]
+        return len(text)
 
-        return mail
+    def flush(self):
+        self.out.flush()
 
 class MaildirDatabase(mailbox.Maildir):
-    """ you should realy consider using some kind of database for this """
+    """ Maildir with an sqlite index of the gmail ids, Message-IDs and labels of its messages """
     def __init__(self, path):
         mailbox.Maildir.__init__(self, path)
         self.lock()
 
-        self.__message_ids = shelve.open(os.path.join(path, 'gmail-sync-labels'))
-        if not '__VERSION' in self.__message_ids.keys() or self.__message_ids['__VERSION'] != DATA_VERSION:
-            print('New database or new software version, re-indexing')
-            # calling .clear() is very slow on a full database
-            # a fully portable way of finding what files to delete is non-trivial(?)
-            # but we can tell the underlying library to start fresh
-            #self.__message_ids.clear()
-            self.__message_ids.close()
-            #os.unlink(os.path.join(path, 'gmail-sync-labels'))
-            self.__message_ids = shelve.open(os.path.join(path, 'gmail-sync-labels'), flag='n')
-            self.__message_ids['__VERSION'] = DATA_VERSION
-        # don't need this data yet
-        #self.cache_message_info()
-    
+        dbpath = os.path.join(path, 'gmail-sync-labels.sqlite')
+        # labels are applied in a writer thread while the next ones download,
+        # only ever one thread at a time though
+        self.__db = sqlite3.connect(dbpath, check_same_thread=False)
+        if self.__get_meta('version') != DATA_VERSION:
+            if self.__get_meta('version') != None:
+                print('New software version, re-indexing')
+                self.__db.close()
+                os.unlink(dbpath)
+                self.__db = sqlite3.connect(dbpath, check_same_thread=False)
+            self.__create()
+            if not self.__migrate_shelve(os.path.join(path, 'gmail-sync-labels')):
+                print('New database, indexing')
+        # the index is always rebuilt from the maildir if lost,
+        # so trading a little durability for speed is fine
+        self.__db.execute('PRAGMA journal_mode = WAL')
+        self.__db.execute('PRAGMA synchronous = NORMAL')
+        # labels not written to the message files yet, see LABEL_STORE
+        self.__db.executescript('''
+            CREATE TABLE IF NOT EXISTS sidecar (key TEXT PRIMARY KEY, gmailid TEXT, labels TEXT);
+            CREATE INDEX IF NOT EXISTS sidecar_gmailid ON sidecar (gmailid);
+        ''')
+        # checkpoint of a full sync in progress, see start_sweep
+        self.__db.execute('CREATE TABLE IF NOT EXISTS sweep (first INTEGER, last INTEGER)')
+        # UIDs gmail refused to fetch, see set_sync_state
+        self.__db.execute('CREATE TABLE IF NOT EXISTS skipped (uid INTEGER PRIMARY KEY)')
+        # where each message's file was at the last scan, see init
+        self.__db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, subdir TEXT, name TEXT);
+            CREATE INDEX IF NOT EXISTS files_subdir ON files (subdir);
+        ''')
+        self.__uncommitted = 0
+        # in-memory lookup tables, see cache_message_info
+        self.__gmailids = None
+        # mailbox's temporary file names aren't unique across threads
+        self.__tmplock = threading.Lock()
+
+    def __create(self):
+        self.__db.executescript('''
+            CREATE TABLE meta (name TEXT PRIMARY KEY, value);
+            -- labels is what X-GMAIL-LABELS was last set to in the file
+            CREATE TABLE messages (key TEXT PRIMARY KEY, gmailid TEXT, threadid TEXT, labels TEXT);
+            CREATE INDEX messages_gmailid ON messages (gmailid);
+            CREATE INDEX messages_threadid ON messages (threadid);
+            CREATE INDEX messages_labels ON messages (labels);
+            -- one row per Message-ID header, a message can have none or several
+            CREATE TABLE message_ids (messageid TEXT NOT NULL, key TEXT NOT NULL);
+            CREATE INDEX message_ids_messageid ON message_ids (messageid);
+            CREATE INDEX message_ids_key ON message_ids (key);
+        ''')
+        self.__set_meta('version', DATA_VERSION)
+        self.__db.commit()
+
+    def __migrate_shelve(self, shelvepath):
+        """ carry over the index of the shelve based DATA_VERSION 4 """
+        try:
+            old = shelve.open(shelvepath, flag='r')
+        except dbm.error:
+            return False
+        try:
+            if old.get('__VERSION') != 4:
+                return False
+            print('Migrating index from %s' % shelvepath)
+            for key in old:
+                if key.startswith('__'):
+                    continue
+                self.__add(key, old[key])
+            state = old.get('__SYNCSTATE')
+            if state != None:
+                self.set_sync_state(state['folder'], state['UIDVALIDITY'], state['HIGHESTMODSEQ'])
+            self.__db.commit()
+            print('Migration complete, the old %s files can be removed' % shelvepath)
+            return True
+        finally:
+            old.close()
+
+    def __get_meta(self, name):
+        try:
+            row = self.__db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        except sqlite3.OperationalError:
+            # no meta table, i.e. a new database
+            return None
+        if row == None:
+            return None
+        return row[0]
+
+    def __set_meta(self, name, value):
+        self.__db.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+    def __add(self, key, info):
+        self.__db.execute('INSERT OR REPLACE INTO messages (key, gmailid, threadid, labels) VALUES (?, ?, ?, ?)',
+            (key, info['X-GMAIL-MSGID'], info.get('X-GMAIL-THRID'), info.get('X-GMAIL-LABELS')))
+        self.__db.execute('DELETE FROM message_ids WHERE key = ?', (key,))
+        self.__db.executemany('INSERT INTO message_ids (messageid, key) VALUES (?, ?)',
+            ((messageid, key) for messageid in info['Message-ID']))
+
+    def __remove(self, key):
+        self.__db.execute('DELETE FROM files WHERE key = ?', (key,))
+        self.__db.execute('DELETE FROM messages WHERE key = ?', (key,))
+        self.__db.execute('DELETE FROM message_ids WHERE key = ?', (key,))
+        self.__db.execute('DELETE FROM sidecar WHERE key = ?', (key,))
+
     def cache_message_info(self):
-        # construct secondary indexes in memory
-        self.__message_id_to_key = {}
-        self.__gmail_id_to_key = {}
-        # some messages don't have a message-id, we can't handle them yet
-        # using gmail's message id may be a way around this
-        self.__message_keys_without_id = set()
-        # same problem with message ids that are duplicated
-        self.__duplicated_message_ids = set()
+        """
+        Checks the index is usable, and loads what apply_labels looks up for
+        every message into sorted arrays: 24 bytes per gmail id (its rowid
+        and the hash of its labels) and 16 per Message-ID (a 64 bit hash and
+        a rowid), instead of a couple of sqlite queries per message.  They
+        are rebuilt from the index every run, which takes a second or two
+        per million messages.
+        """
         foundfatalerrors = False
-        for key in self.__message_ids:
-            if key == '__VERSION':
-                continue
-            info = self.__message_ids[key]
-            gmailid = info['X-GMAIL-MSGID']
-            if gmailid != None:
-                if gmailid in self.__gmail_id_to_key.keys():
-                    print('duplicate gmail id %s in %s and %s' % (gmailid, key, self.__gmail_id_to_key[gmailid]))
-                    foundfatalerrors = True
-                else:
-                    self.__gmail_id_to_key[gmailid] = key
-            messageids = info['Message-ID']
-            for messageid in messageids:
-                if messageid in self.__message_id_to_key.keys():
-                    # duplicated
-                    self.__duplicated_message_ids.add(messageid)
-                    del self.__message_id_to_key[messageid]
-                if messageid not in self.__duplicated_message_ids:
-                    self.__message_id_to_key[messageid] = key
-            if len(messageids) == 0:
-                self.__message_keys_without_id.add(key)
-            elif config.DEBUG and len(messageids) > 1:
+        for gmailid, keys in self.__db.execute('''
+                SELECT gmailid, GROUP_CONCAT(key, ' and ') FROM messages
+                WHERE gmailid IS NOT NULL GROUP BY gmailid HAVING COUNT(*) > 1'''):
+            print('duplicate gmail id %s in %s' % (gmailid, keys))
+            foundfatalerrors = True
+        if config.DEBUG:
+            for key, in self.__db.execute('''
+                    SELECT key FROM message_ids GROUP BY key HAVING COUNT(*) > 1'''):
                 print('Message with multiple IDs: %s' % key)
         if config.DEBUG or config.MESSAGE_DETAILS:
+            good, duplicated = self.__db.execute('''
+                SELECT COALESCE(SUM(n = 1), 0), COALESCE(SUM(n > 1), 0) FROM
+                (SELECT COUNT(*) AS n FROM message_ids GROUP BY messageid)''').fetchone()
+            # some messages don't have a message-id, they can only be found by gmail id
+            missing, = self.__db.execute('''
+                SELECT COUNT(*) FROM messages
+                WHERE key NOT IN (SELECT key FROM message_ids)''').fetchone()
             print('cached index: %d good message ids, %d duplicated ids, %d missing ids' %
-                (len(self.__message_id_to_key), len(self.__duplicated_message_ids),
-                len(self.__message_keys_without_id)))
+                (good, duplicated, missing))
         if foundfatalerrors:
             assert False, 'Found fatal errors, cannot continue'
 
-    def init(self):
+        # gmail ids that aren't plain numbers can't match one from gmail anyway
+        self.__gmailids = array.array('q')
+        self.__gmailrows = array.array('q')
+        self.__labelhashes = array.array('q')
+        # with LABEL_STORE = 'sidecar' the labels to compare with are elsewhere
+        sidecar = getattr(config, 'LABEL_STORE', 'headers') == 'sidecar'
+        for gmailid, rowid, labels in self.__db.execute('''
+                SELECT CAST(gmailid AS INTEGER), rowid, labels FROM messages
+                WHERE CAST(CAST(gmailid AS INTEGER) AS TEXT) = gmailid
+                ORDER BY CAST(gmailid AS INTEGER)'''):
+            self.__gmailids.append(gmailid)
+            self.__gmailrows.append(rowid)
+            self.__labelhashes.append(0 if sidecar else labels_hash(labels))
+        # a rowid, 0 for a Message-ID on several messages, -1 when different
+        # Message-IDs share the hash and only sqlite can tell them apart
+        self.__db.create_function('str_hash', 1, hash)
+        self.__msgidhashes = array.array('q')
+        self.__msgidrows = array.array('q')
+        for h, ids, count, rowid in self.__db.execute('''
+                SELECT str_hash(messageid) AS h, COUNT(DISTINCT messageid), COUNT(*), MIN(messages.rowid)
+                FROM message_ids JOIN messages USING (key) GROUP BY h ORDER BY h'''):
+            self.__msgidhashes.append(h)
+            self.__msgidrows.append(-1 if ids > 1 else 0 if count > 1 else rowid)
+
+    def init(self, jobs=1, rescan=False):
+        """
+        Brings the index up to date with the maildir, yielding progress.
+
+        Only cur/ or new/ whose mtime changed since the last scan are
+        listed, and only what was added to or removed from them is looked
+        at; a file renamed for new flags, or moved from new/ to cur/, is
+        the same message.  rescan lists both regardless.
+        """
         i = 0
         seen = 0
         nomsgid = 0
         nogmailid = 0
-        
-        # message ids can have comments, extract just the <id@id> part
-        # this is not perfect, comments might have strings that look like message ids
-        # would need a full BNF parser for the productions in RFC2822 to handle this exactly right
-        # need this because message ids gmail returns on queries have the comments stripped off
-        extractmsgid = re.compile('.*?(<.*>).*')
-        
-        # track what message keys still exist, remove others from the cache
-        seenkeys = set()
-        
+
+        # key => (subdir, name) of the files in the directories that changed
+        listed = dict()
+        changed = []
+        mtimes = dict()
+        for subdir in ('new', 'cur'):
+            # taken before listing, so a change while listing shows up next time
+            mtime = os.stat(self._paths[subdir]).st_mtime_ns
+            if not rescan and mtime == self.__get_meta('mtime_' + subdir):
+                continue
+            changed.append(subdir)
+            metrics.count('maildir_dirs_listed')
+            with os.scandir(self._paths[subdir]) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        listed[entry.name.split(self.colon)[0]] = (subdir, entry.name)
+            # the same as mailbox does: an mtime this recent might not change
+            # again for a change made right after the listing, don't trust it;
+            # and only record it once everything in it is indexed
+            mtimes[subdir] = mtime if time.time() - mtime / 1e9 >= 2 else None
+
+        # what the last scan found in them
+        known = dict((key, (subdir, name)) for key, subdir, name in self.__db.execute(
+            'SELECT key, subdir, name FROM files WHERE subdir IN (%s)' % ','.join('?' * len(changed)), changed))
+        newkeys = []
+
         # process messages in deterministic order in debug mode
         # don't waste time sorting otherwise
-        for key in sorted(self.iterkeys()) if config.DEBUG else self.iterkeys():
-            seenkeys.add(key)
-            i += 1
-
-            if i % 100 == 0:
-                yield i
-            
-            if i % 1000 == 0:
-                if config.DEBUG:
-                    print('snapshotting messages, seen %d of %d, missing %d/%d' % (seen, i, nomsgid, nogmailid))
-                self.__message_ids.sync()
+        for key in sorted(listed) if config.DEBUG else listed:
+            place = listed[key]
+            if known.pop(key, None) == place:
+                seen += 1
+                i += 1
+                if i % 100 == 0:
+                    yield i
+                continue
 
-            # TODO: re-process messages with a message id but no gmail id,
-            # as a prior run may have added the gmail id
-            if key in self.__message_ids.keys():
+            # renamed, or moved between new/ and cur/; new ones are
+            # only added to the list of files once they are indexed
+            if self.__db.execute('SELECT 1 FROM messages WHERE key = ?', (key,)).fetchone() != None:
+                self.__db.execute('INSERT OR REPLACE INTO files (key, subdir, name) VALUES (?, ?, ?)', (key,) + place)
                 seen += 1
+                i += 1
+                if i % 100 == 0:
+                    yield i
                 continue
-            
-            messageids = []
-            gmailid = None
-            
-            message = self.get(key)
-            for k, v in message.items():
-                ku = k.upper()
-                # don't decode every header, both for performance
-                # and to avoid getting stuck on bogusly encoded headers
-                # that we don't care about to begin with
-                if ku == 'MESSAGE-ID':
-                    vv = header_to_string(v)
-                    idx = extractmsgid.match(vv)
-                    if idx == None:
-                        if config.DEBUG:
-                            print("Bogus looking message id '%s', tracking as-is" % (vv))
-                        messageids.append(vv)
-                    else:
-                        messageids.append(idx.groups()[0])
-                elif ku == 'X-GMAIL-MSGID':
-                    # gmailid should never be duplicated
-                    assert(gmailid == None)
-                    vv = header_to_string(v)
-                    gmailid = vv
-            
-            if len(messageids) == 0:
-                nomsgid += 1
-            if gmailid == None:
-                nogmailid += 1
-            
-            # gmailid should always be present
-            assert(gmailid != None)
-            self.__message_ids[key] = { 'Message-ID': messageids, 'X-GMAIL-MSGID': gmailid }
+
+            newkeys.append(key)
+
+        # with everything listed, whatever else the index has is gone too;
+        # an index from before the list of files was kept has no other way
+        # of finding out about messages deleted back then
+        if len(changed) == 2:
+            for key, in self.__db.execute('SELECT key FROM messages').fetchall():
+                if key not in listed:
+                    known[key] = None
+
+        # messages indexed without a gmail id are read again, a newer copy
+        # of the file may have it
+        retrykeys = set(key for key, in self.__db.execute('SELECT key FROM messages WHERE gmailid IS NULL'))
+        newkeys += [key for key in retrykeys if key not in known]
+
+        def path(key):
+            if key in listed:
+                return os.path.join(self._path, *listed[key])
+            return self.message_path(key)
+
+        if jobs > 1 and len(newkeys) > 0:
+            # reading and parsing the headers is the expensive part, farm
+            # that out, but keep all the writes to the index in this process
+            batches = [[(key, path(key)) for key in newkeys[n:n + 100]]
+                for n in range(0, len(newkeys), 100)]
+            pool = multiprocessing.Pool(jobs)
+            indexed = (entry for batch in pool.imap_unordered(index_messages, batches) for entry in batch)
+        else:
+            pool = None
+            indexed = ((key, message_index_info(read_message_headers(path(key)))) for key in newkeys)
+
+        try:
+            for key, info in indexed:
+                i += 1
+
+                if i % 100 == 0:
+                    yield i
+
+                if i % 1000 == 0:
+                    if config.DEBUG:
+                        print('snapshotting messages, seen %d of %d, missing %d/%d' % (seen, i, nomsgid, nogmailid))
+                    self.__db.commit()
+
+                messageids = info['Message-ID']
+                gmailid = info['X-GMAIL-MSGID']
+
+                if config.DEBUG:
+                    for messageid in messageids:
+                        if extractmsgid.match(messageid) == None:
+                            print("Bogus looking message id '%s', tracking as-is" % (messageid))
+
+                if len(messageids) == 0:
+                    nomsgid += 1
+                if gmailid == None:
+                    nogmailid += 1
+
+                # gmailid should always be present, except in what an older
+                # version indexed
+                assert(gmailid != None or key in retrykeys)
+                self.__add(key, info)
+                if key in listed:
+                    self.__db.execute('INSERT OR REPLACE INTO files (key, subdir, name) VALUES (?, ?, ?)',
+                        (key,) + listed[key])
+        finally:
+            if pool != None:
+                pool.terminate()
         
-        # remove any deleted messages from index
-        for key in list(self.__message_ids.keys() - seenkeys):
-            if key == '__VERSION':
-                continue
+        # remove any deleted messages from index, whatever is left of
+        # the last scan of a changed directory is gone
+        for key in known:
             if config.DEBUG:
                 print('removing obsolete key %s' % key)
-            del self.__message_ids[key]
+            self.__remove(key)
+        for subdir, mtime in mtimes.items():
+            self.__set_meta('mtime_' + subdir, mtime)
+        self.__db.commit()
         
         # update in-memory caches    
-        self.cache_message_info()
+        with metrics.phase('cache'):
+            self.cache_message_info()
+        metrics.count('messages_indexed', i - seen)
         
+        if len(changed) == 0:
+            print('maildir unchanged since the last scan')
         print('seen %d messages, processed %d messages' % (seen, i - seen))
         print('processed with no id: %d, no gmail id: %d' % (nomsgid, nogmailid))
 
+    def message_path(self, key):
+        row = self.__db.execute('SELECT subdir, name FROM files WHERE key = ?', (key,)).fetchone()
+        if row != None:
+            path = os.path.join(self._path, row[0], row[1])
+            if os.path.exists(path):
+                return path
+        # renamed since the last scan, e.g. marked read by a mail reader
+        return os.path.join(self._path, self._lookup(key))
+
+    def message_count(self):
+        """ number of messages as of the last scan, without listing the maildir """
+        count, = self.__db.execute('SELECT COUNT(*) FROM files').fetchone()
+        return count
+
+    def get_sync_state(self, folder):
+        """ (UIDVALIDITY, HIGHESTMODSEQ) of the last complete sync of folder, or None """
+        if self.__get_meta('sync_folder') != folder:
+            return None
+        return self.__get_meta('sync_uidvalidity'), self.__get_meta('sync_highestmodseq')
+
+    def set_sync_state(self, folder, uidvalidity, highestmodseq, skipped=()):
+        """
+        records a complete sync, but for the UIDs in skipped, which gmail
+        refused to fetch; the incremental syncs after it retry those
+        """
+        self.__set_meta('sync_folder', folder)
+        self.__set_meta('sync_uidvalidity', uidvalidity)
+        self.__set_meta('sync_highestmodseq', highestmodseq)
+        self.__db.execute('DELETE FROM skipped')
+        self.__db.executemany('INSERT OR IGNORE INTO skipped (uid) VALUES (?)', ((uid,) for uid in skipped))
+        self.__db.commit()
+
+    def get_skipped(self):
+        """ the UIDs left out of the last sync, see set_sync_state """
+        return [uid for uid, in self.__db.execute('SELECT uid FROM skipped ORDER BY uid')]
+
+    def start_sweep(self, folder, uidvalidity, highestmodseq, last):
+        """
+        Starts the checkpoint of a full sync of the UIDs 1 to last, which
+        becomes the sync state at highestmodseq once the sweep is done.
+        """
+        self.__db.execute('DELETE FROM sweep')
+        self.__set_meta('sweep_folder', folder)
+        self.__set_meta('sweep_uidvalidity', uidvalidity)
+        self.__set_meta('sweep_highestmodseq', highestmodseq)
+        self.__set_meta('sweep_last', last)
+        self.__db.commit()
+
+    def get_sweep(self, folder, uidvalidity):
+        """ (highestmodseq, last, done UID ranges) of an interrupted full sync of folder, or None """
+        if self.__get_meta('sweep_folder') != folder or self.__get_meta('sweep_uidvalidity') != uidvalidity:
+            return None
+        done = self.__db.execute('SELECT first, last FROM sweep ORDER BY first').fetchall()
+        return self.__get_meta('sweep_highestmodseq'), self.__get_meta('sweep_last'), done
+
+    def add_swept(self, ranges):
+        """ records UID ranges whose labels are all applied """
+        self.__db.executemany('INSERT INTO sweep (first, last) VALUES (?, ?)', ranges)
+        self.__db.commit()
+        self.__uncommitted = 0
+
+    def known_labels(self):
+        """ all the labels messages had when last synced """
+        labels = set()
+        for value, in self.__db.execute('SELECT DISTINCT labels FROM messages WHERE labels IS NOT NULL'):
+            # headers written by getmail may still be RFC 2047 encoded
+            labels.update(gmailimap.split_labels(header_to_string(value)))
+        return labels
+
+    def finish_sweep(self):
+        self.__db.execute('DELETE FROM sweep')
+        self.__set_meta('sweep_folder', None)
+        self.__db.commit()
+
     def close(self):
-        self.__message_ids.close()
+        self.__db.commit()
+        self.__db.close()
         self.unlock()
 
-    def apply_labels(self, msgid, gmailid, gmailthreadid, labels):
-        key = None
+    def find_message(self, msgid, gmailid):
+        """ Maildir key of the message with the given gmail id or Message-ID, or None """
+        if self.__gmailids != None:
+            return self.__find_cached(msgid, gmailid)
         if gmailid != None:
-            try:
-                key = self.__gmail_id_to_key[gmailid]
-            except KeyError:
+            row = self.__db.execute('SELECT key FROM messages WHERE gmailid = ?', (gmailid,)).fetchone()
+            if row != None:
+                return row[0]
+            if config.DEBUG or config.MESSAGE_DETAILS:
+                print("Can't find message by gmail id %s, retrying by message id %s" % (gmailid, msgid))
+        if msgid != None:
+            rows = self.__db.execute('SELECT key FROM message_ids WHERE messageid = ? LIMIT 2', (msgid,)).fetchall()
+            if len(rows) == 1:
+                return rows[0][0]
+            if len(rows) > 1:
                 if config.DEBUG or config.MESSAGE_DETAILS:
-                    print("Can't find message by gmail id %s, retrying by message id %s" % (gmailid, msgid))
-        if key == None and msgid != None:
-            try:
-                key = self.__message_id_to_key[msgid]
-            except KeyError:
-                if msgid in self.__duplicated_message_ids:
-                    if config.DEBUG or config.MESSAGE_DETAILS:
-                        print("skipping message with duplicated id: '%s'" % msgid)
+                    print("skipping message with duplicated id: '%s'" % msgid)
+        return None
+
+    def __find_cached(self, msgid, gmailid):
+        """ find_message out of the lookup tables, for when they are loaded """
+        if gmailid != None:
+            n = find_sorted(self.__gmailids, int(gmailid))
+            if n != None:
+                return self.__db.execute('SELECT key FROM messages WHERE rowid = ?', (self.__gmailrows[n],)).fetchone()[0]
+            if config.DEBUG or config.MESSAGE_DETAILS:
+                print("Can't find message by gmail id %s, retrying by message id %s" % (gmailid, msgid))
+        if msgid != None:
+            n = find_sorted(self.__msgidhashes, hash(msgid))
+            if n == None:
+                return None
+            rowid = self.__msgidrows[n]
+            if rowid == 0:
+                if config.DEBUG or config.MESSAGE_DETAILS:
+                    print("skipping message with duplicated id: '%s'" % msgid)
+                return None
+            # the hash only says it's likely there, check the Message-ID itself
+            rows = self.__db.execute('''
+                SELECT key FROM message_ids WHERE messageid = ? AND (? < 0 OR key =
+                (SELECT key FROM messages WHERE rowid = ?)) LIMIT 2''', (msgid, rowid, rowid)).fetchall()
+            if len(rows) == 1:
+                return rows[0][0]
+            if len(rows) > 1:
+                if config.DEBUG or config.MESSAGE_DETAILS:
+                    print("skipping message with duplicated id: '%s'" % msgid)
+        return None
+
+    def labels_unchanged(self, gmailid, labels):
+        """
+        whether the index says the message with this gmail id has exactly
+        this labels text, without asking sqlite; False if it can't tell
+        """
+        if self.__gmailids == None or gmailid == None or labels == None:
+            return False
+        n = find_sorted(self.__gmailids, int(gmailid))
+        return n != None and self.__labelhashes[n] == labels_hash(labels)
+
+    def apply_labels(self, msgid, gmailid, gmailthreadid, labels):
+        # most messages didn't change since the last run, not even the order
+        # of their labels (never true with LABEL_STORE = 'sidecar')
+        if self.labels_unchanged(gmailid, labels):
+            return 0
+
+        key = self.find_message(msgid, gmailid)
         
         if key == None:
             if config.DEBUG or config.MESSAGE_DETAILS:
                 print("no such message: '%s' / '%s'" % (msgid, gmailid))
             return -1
         
-        msg = self[key]
-        if msg['X-GMAIL-LABELS'] == labels:
+        if getattr(config, 'LABEL_STORE', 'headers') == 'sidecar':
+            return self.store_labels(key, gmailid, labels)
+
+        # most messages didn't change since the last run,
+        # don't bother reading them to find that out
+        cached, = self.__db.execute('SELECT labels FROM messages WHERE key = ?', (key,)).fetchone()
+        if same_labels(cached, labels):
+            return 0
+        
+        try:
+            old = self.write_labels(key, labels)
+        except (KeyError, FileNotFoundError):
+            # deleted since the last scan
+            if config.DEBUG or config.MESSAGE_DETAILS:
+                print("message file of %s is gone: '%s' / '%s'" % (key, msgid, gmailid))
+            return -1
+        self.__set_labels(key, labels)
+        if old == labels:
+            # the cache was behind the file, e.g. right after a migration
             return 0
         
         if config.DEBUG:
-            print("Updating message %s: '%s'/%s/%s => '%s'" % (key, msgid, gmailid, msg['X-GMAIL-LABELS'], labels))
+            print("Updating message %s: '%s'/%s/%s => '%s'" % (key, msgid, gmailid, old, labels))
         
-        del msg['X-GMAIL-LABELS']
-        msg['X-GMAIL-LABELS'] = labels
+        return 1
 
-        self[key] = msg
-        
+    def write_labels(self, key, labels, path=None):
+        """
+        Set the X-GMAIL-LABELS header of a message, returns its previous value.
+
+        Only the header block is rewritten.  If the new labels fit where the
+        old ones were, that line is patched in place, otherwise the new
+        headers and the body (copied in the kernel) go to a new file which
+        then replaces the old one, like mailbox.Maildir.__setitem__ does.
+        Given its path, the index isn't used, so it can run in any thread.
+        """
+        if path == None:
+            path = self.message_path(key)
+        with open(path, 'rb') as f:
+            lines, end = read_header_block(f)
+            bodyoffset = sum(len(line) for line in lines) + len(end)
+            fields = split_header_fields(lines)
+            slots = [n for n, field in enumerate(fields)
+                if field[0].split(b':', 1)[0].strip().lower() == b'x-gmail-labels']
+
+            old = None
+            if len(slots) > 0:
+                # same value the email parser would give
+                value = b''.join(fields[slots[0]]).split(b':', 1)[1]
+                old = header_labels(value.decode('ascii', 'surrogateescape')
+                    .replace('\r\n', '\n').lstrip(' \t').rstrip('\r\n'))
+                if len(slots) == 1 and old == labels:
+                    return old
+
+            value = b' ' + labels.encode('utf-8')
+            st = os.fstat(f.fileno())
+
+            # patching in place would also change any hard linked copies,
+            # as kept by some backup tools, so only do that for a single link
+            if len(slots) == 1 and len(fields[slots[0]]) == 1 and st.st_nlink == 1:
+                line = fields[slots[0]][0]
+                name = line.split(b':', 1)[0] + b':'
+                room = len(line.rstrip(b'\r\n')) - len(name)
+                if len(value) <= room:
+                    offset = sum(len(line) for field in fields[:slots[0]] for line in field) + len(name)
+                    with open(path, 'r+b') as out:
+                        os.pwrite(out.fileno(), value.ljust(room, b' '), offset)
+                    metrics.count('files_patched')
+                    metrics.count('bytes_written', room)
+                    # the mtime is left to change: the size doesn't, and
+                    # backup tools like rsync would skip the file otherwise
+                    return old
+
+            newline = b'\r\n' if len(lines) > 0 and lines[0].endswith(b'\r\n') else b'\n'
+            # leave some room for the labels to grow next time
+            field = [b'X-GMAIL-LABELS:' + value + b' ' * getattr(config, 'LABEL_PADDING', 0) + newline]
+            if len(slots) > 0:
+                fields[slots[0]] = field
+                for n in reversed(slots[1:]):
+                    del fields[n]
+            else:
+                if len(fields) > 0 and not fields[-1][-1].endswith(b'\n'):
+                    fields[-1][-1] += newline
+                fields.append(field)
+            if end == b'':
+                end = newline
+
+            with self.__tmplock:
+                tmp = self._create_tmp()
+            try:
+                header = b''.join(line for field in fields for line in field) + end
+                tmp.write(header)
+                copy_file_data(f, tmp, bodyoffset)
+                metrics.count('files_rewritten')
+                metrics.count('bytes_written', len(header) + st.st_size - bodyoffset)
+                os.fchmod(tmp.fileno(), stat.S_IMODE(st.st_mode))
+                tmp.close()
+                os.utime(tmp.name, ns=(st.st_atime_ns, st.st_mtime_ns))
+                os.replace(tmp.name, path)
+            except:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        return old
+
+    def store_labels(self, key, gmailid, labels):
+        """ record new labels for a message in the sidecar table, leaving the file alone """
+        cached, pending = self.__db.execute('''
+            SELECT messages.labels, sidecar.labels FROM messages LEFT JOIN sidecar USING (key)
+            WHERE key = ?''', (key,)).fetchone()
+        if pending == None:
+            pending = cached
+        if same_labels(pending, labels):
+            return 0
+
+        if config.DEBUG:
+            print("Storing labels of message %s: '%s' => '%s'" % (key, pending, labels))
+
+        # the sidecar only holds labels that differ from the file
+        if cached == labels:
+            self.__db.execute('DELETE FROM sidecar WHERE key = ?', (key,))
+        else:
+            self.__db.execute('INSERT OR REPLACE INTO sidecar (key, gmailid, labels) VALUES (?, ?, ?)',
+                (key, gmailid, labels))
+        self.__changed()
         return 1
 
-#FIXME: refactor to separate class o share code
-def download_labels(gmail, total):
+    def apply_planned(self, changes, workers):
+        """
+        Carries out the (key, gmailid, old labels, new labels) changes of a
+        LabelPlan, skipping messages whose labels aren't the old ones any
+        more; returns how many were (applied, skipped).  The files are
+        rewritten by workers threads, in directory and file name order.
+        """
+        sidecar = getattr(config, 'LABEL_STORE', 'headers') == 'sidecar'
+        applied = 0
+        stale = []
+        todo = []
+        for key, gmailid, old, labels in changes:
+            if self.message_labels(key) != old:
+                stale.append(key)
+            elif sidecar:
+                applied += self.store_labels(key, gmailid, labels)
+            else:
+                try:
+                    todo.append((self.message_path(key), key, labels))
+                except KeyError:
+                    # deleted since
+                    stale.append(key)
+        todo.sort()
+
+        gone = object()
+        def write(change):
+            path, key, labels = change
+            try:
+                return self.write_labels(key, labels, path)
+            except FileNotFoundError:
+                # renamed or deleted meanwhile, sorted out below
+                return gone
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            # a slice at a time, not a future per message all at once
+            for n in range(0, len(todo), 1000):
+                chunk = todo[n:n + 1000]
+                for (path, key, labels), old in zip(chunk, pool.map(write, chunk)):
+                    if old is gone:
+                        # e.g. a mail reader marked it read, look it up once more
+                        try:
+                            old = self.write_labels(key, labels)
+                        except (KeyError, FileNotFoundError):
+                            stale.append(key)
+                            continue
+                    self.__set_labels(key, labels)
+                    if config.DEBUG:
+                        print("Updating message %s: %s => '%s'" % (key, old, labels))
+                    applied += 1
+                if os.isatty(1):
+                    print('progress: %d/%d' % (n + len(chunk), len(todo)), end='\r', flush=True)
+        if config.DEBUG or config.MESSAGE_DETAILS:
+            for key in stale:
+                print('%s changed or went away since the plan, skipped' % key)
+        self.__db.commit()
+        return applied, len(stale)
+
+    def message_labels(self, key):
+        """ current labels of a message, including ones only in the sidecar """
+        row = self.__db.execute('''
+            SELECT COALESCE(sidecar.labels, messages.labels) FROM messages LEFT JOIN sidecar USING (key)
+            WHERE key = ?''', (key,)).fetchone()
+        if row == None:
+            return None
+        return row[0]
+
+    def export_labels(self):
+        """ write the labels in the sidecar into the message files """
+        i = 0
+        missing = 0
+        for key, labels in self.__db.execute('SELECT key, labels FROM sidecar ORDER BY key').fetchall():
+            i += 1
+            if i % 100 == 0:
+                yield i
+            try:
+                self.write_labels(key, labels)
+            except (KeyError, FileNotFoundError):
+                # deleted since, nowhere to write them
+                if config.DEBUG or config.MESSAGE_DETAILS:
+                    print('message file of %s is gone, dropping its labels' % key)
+                self.__db.execute('DELETE FROM sidecar WHERE key = ?', (key,))
+                missing += 1
+                continue
+            self.__db.execute('DELETE FROM sidecar WHERE key = ?', (key,))
+            self.__set_labels(key, labels)
+        self.__db.commit()
+        print('exported labels of %d messages, %d were gone' % (i - missing, missing))
+
+    def __set_labels(self, key, labels):
+        self.__db.execute('UPDATE messages SET labels = ? WHERE key = ?', (labels, key))
+        if self.__gmailids != None:
+            gmailid, = self.__db.execute('SELECT gmailid FROM messages WHERE key = ?', (key,)).fetchone()
+            n = find_sorted(self.__gmailids, int(gmailid)) if gmailid != None and gmailid.isdigit() else None
+            if n != None and getattr(config, 'LABEL_STORE', 'headers') != 'sidecar':
+                self.__labelhashes[n] = labels_hash(labels)
+        self.__changed()
+
+    def __changed(self):
+        # commit in batches, a transaction per message would be slow
+        self.__uncommitted += 1
+        if self.__uncommitted >= 1000:
+            self.__db.commit()
+            self.__uncommitted = 0
+
+    def verify_labels(self):
+        """ re-read the labels of every message, fixing up the cached ones that are wrong """
+        i = 0
+        wrong = 0
+        missing = 0
+        for key, cached in self.__db.execute('SELECT key, labels FROM messages').fetchall():
+            i += 1
+            if i % 100 == 0:
+                yield i
+            try:
+                labels = header_labels(read_message_headers(self.message_path(key))['X-GMAIL-LABELS'])
+            except (KeyError, FileNotFoundError):
+                # deleted since the last scan
+                if config.DEBUG or config.MESSAGE_DETAILS:
+                    print('message file of %s is gone, removing it from the index' % key)
+                self.__remove(key)
+                missing += 1
+                continue
+            if labels != cached:
+                if config.DEBUG or config.MESSAGE_DETAILS:
+                    print("Cached labels of %s are wrong: '%s', file has '%s'" % (key, cached, labels))
+                self.__set_labels(key, labels)
+                wrong += 1
+        self.__db.commit()
+        if missing > 0:
+            # the lookup tables still have them
+            self.cache_message_info()
+        print('verified %d messages, %d had wrong cached labels, %d were gone' % (i, wrong, missing))
+
+class FetchScheduler:
     """
-    response here is ugly:
-
-    [(b'1 (X-GM-MSGID 1222139561679786370 X-GM-LABELS () BODY[HEADER.FIELDS (MESSAGE-ID)] {61}',
-      b'Message-ID: <a38097d40612071225s1e399c3eu@mail.gmail.com>\r\n\r\n'),
-     b')',
-     (b'2 (X-GM-MSGID 1222140200241725271 X-GM-LABELS () BODY[HEADER.FIELDS (MESSAGE-ID)] {40}',
-      b'Message-ID: <45787AFA.7020202@wp.pl>\r\n\r\n'),
-     b')',
-     ...
-    ]
+    Hands out the ranges of message UIDs to fetch, 1 to last, skipping
+    the ones in done (say from an interrupted run).
+
+    Ranges gmail refuses are split in half and retried, so a bad message is
+    found in a few requests and everything else in its range still gets
+    fetched.  The size of new ranges follows how long the previous ones
+    took and how much they returned.  Shared by all connections.
     """
-    regexp = re.compile('(\d+) \(X-GM-THRID (\d+) X-GM-MSGID (\d+) X-GM-LABELS \((.*)\) BODY\[HEADER.FIELDS \(MESSAGE-ID\)\] {(\d+)}')
-    
-    # gmail doesn't like doing large fetches, so batch it up into chunks
-    chunk_size = 1000
-    for chunk_start in range(1, total, chunk_size):
-        # ranges in the imap fetch are inclusive, so care for fenceposts
-        chunk_end = min(total, chunk_start + chunk_size - 1)
-        # gmail gets cranky sometimes and just refuses to list some messages
-        # if we get an error, skip one forwards
-        # if the problem message is the last one, this will take forever
-        # better would be to bisect the range, but that requires state tracking
-        resp = None
-        while resp == None and chunk_start <= chunk_end:
-            resp = gmail.fetch('%d:%d' % (chunk_start, chunk_end), '(X-GM-THRID X-GM-MSGID X-GM-LABELS BODY[HEADER.FIELDS (MESSAGE-ID)])')
-            if resp[0] == 'OK':
-                break
-            resp = None
-            chunk_start += 1
-        # no messages from this chunk were available, move on to the next chunk
-        if resp == None:
-            print("\nGave up fetching range [%d, %d]" % (chunk_start, chunk_end), file=sys.stderr)
+    # aim for requests of about this many seconds
+    target_time = 2.0
+    # and keep responses below this many bytes
+    max_bytes = 16 << 20
+    min_size = 50
+    # responses are parsed as they arrive, so big ranges don't cost memory
+    max_size = 20000
+
+    def __init__(self, last, chunk_size=1000, skipped=None, done=()):
+        self.last = last
+        self.chunk_size = chunk_size
+        # messages given up on
+        self.skipped = skipped if skipped != None else []
+        # the ranges not to fetch, in order
+        self.__done = sorted(done)
+        self.__next = 1
+        self.__skip_done()
+        self.__retry = []
+        self.__outstanding = 0
+        # messages that already came back from ranges that failed later on
+        self.__delivered = set()
+        self.__changed = asyncio.Event()
+        # set once everything has been fetched or given up on
+        self.complete = False
+        # set when complete, or when aborted
+        self.finished = asyncio.Event()
+
+    def take_nowait(self):
+        """ next (start, end) range to fetch, or None if there is none right now """
+        if self.finished.is_set():
+            return None
+        if len(self.__retry) > 0:
+            chunk = self.__retry.pop()
+        elif self.__next <= self.last:
+            # ranges in the imap fetch are inclusive, so care for fenceposts
+            end = min(self.last, self.__next + self.chunk_size - 1)
+            if len(self.__done) > 0:
+                end = min(end, self.__done[0][0] - 1)
+            chunk = self.__next, end
+            self.__next = end + 1
+            self.__skip_done()
+        else:
+            return None
+        self.__outstanding += 1
+        return chunk
+
+    async def take(self):
+        """ next (start, end) range to fetch, or None once there is nothing left to do """
+        while True:
+            chunk = self.take_nowait()
+            if chunk != None or self.finished.is_set():
+                return chunk
+            # whatever is still being fetched might fail and need splitting
+            self.__changed.clear()
+            await self.__changed.wait()
+
+    def done(self, chunk, elapsed, size):
+        length = chunk[1] - chunk[0] + 1
+        # only full sized ranges say anything about the current size
+        if length >= self.chunk_size:
+            if size > self.max_bytes or elapsed > self.target_time * 2:
+                self.chunk_size = max(self.min_size, self.chunk_size // 2)
+            elif size < self.max_bytes // 2 and elapsed < self.target_time / 2:
+                self.chunk_size = min(self.max_size, self.chunk_size * 3 // 2)
+        self.__release()
+
+    def failed(self, chunk, delivered=()):
+        """ gmail refused to fetch chunk, after returning the messages in delivered """
+        self.__delivered.update(delivered)
+        start, end = chunk
+        if start == end:
+            self.skipped.append(start)
+        else:
+            middle = (start + end) // 2
+            # retried last in, first out, so this keeps going in order
+            self.__retry.append((middle + 1, end))
+            self.__retry.append((start, middle))
+        self.__release()
+
+    def requeue(self, chunk, delivered=()):
+        """ chunk could not be fetched for reasons unrelated to the messages in it """
+        self.__delivered.update(delivered)
+        self.__retry.append(chunk)
+        self.__release()
+
+    def is_new(self, uid):
+        """ False if uid was already returned by an earlier attempt """
+        return uid not in self.__delivered
+
+    def abort(self):
+        self.finished.set()
+        self.__changed.set()
+
+    def __skip_done(self):
+        while len(self.__done) > 0 and self.__done[0][0] <= self.__next:
+            self.__next = max(self.__next, self.__done.pop(0)[1] + 1)
+
+    def __release(self):
+        self.__outstanding -= 1
+        if self.__outstanding == 0 and len(self.__retry) == 0 and self.__next > self.last:
+            self.complete = True
+            self.finished.set()
+        self.__changed.set()
+
+# yielded by the full sync downloads after the messages of a range, so the
+# range can be checkpointed once those are applied
+FetchedRange = collections.namedtuple('FetchedRange', 'first last')
+
+def format_ranges(numbers):
+    """ 1, 2, 3, 7 => '1-3, 7' """
+    ranges = []
+    for number in sorted(numbers):
+        if len(ranges) > 0 and ranges[-1][1] + 1 == number:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ', '.join('%d' % first if first == last else '%d-%d' % (first, last) for first, last in ranges)
+
+def report_skipped(scheduler):
+    if len(scheduler.skipped) > 0:
+        print('\nGave up fetching %d messages, UIDs: %s' % (len(scheduler.skipped), format_ranges(scheduler.skipped)), file=sys.stderr)
+
+# how many fetches to keep in flight on one connection, so gmail is already
+# working on the next range while the current one is being read
+PIPELINE_DEPTH = 3
+
+async def fetch_scheduled(gmail, scheduler, labelsets=None, changedsince=None):
+    """
+    Yields the messages in the ranges scheduler hands out, fetched over gmail,
+    and a FetchedRange after the last message of each range.  Given
+    labelsets, a dict of UID => labels from Gmail.label_sets, only the ids are fetched
+    and the labels taken from there.  Given changedsince, only messages
+    changed since that modseq are.
+
+    If the connection fails, the ranges in flight go back to the scheduler
+    and the error is raised.
+    """
+    def fetch(chunk):
+        if labelsets != None:
+            return gmail.fetch_ids('%d:%d' % chunk, uid=True, msgid=True)
+        return gmail.fetch_labels('%d:%d' % chunk, uid=True, changedsince=changedsince)
+    inflight = collections.deque()
+    # when gmail finished the previous range, it only starts on the next after that
+    lastcompleted = 0
+    try:
+        while True:
+            while len(inflight) < PIPELINE_DEPTH:
+                chunk = scheduler.take_nowait()
+                if chunk == None:
+                    break
+                inflight.append((chunk, fetch(chunk)))
+            if len(inflight) == 0:
+                chunk = await scheduler.take()
+                if chunk == None:
+                    return
+                inflight.append((chunk, fetch(chunk)))
+                continue
+
+            chunk, response = inflight[0]
+            delivered = []
+            try:
+                async for message in response:
+                    delivered.append(message.uid)
+                    if not scheduler.is_new(message.uid):
+                        continue
+                    if labelsets != None:
+                        message = message._replace(labels=labelsets.get(message.uid, ''))
+                    report_missing_msgid(message)
+                    yield message
+            except gmailimap.FetchRefused:
+                inflight.popleft()
+                if config.DEBUG:
+                    print('gmail refused range [%d, %d], splitting it' % chunk)
+                metrics.count('fetch_refused')
+                scheduler.failed(chunk, delivered)
+                continue
+            except BaseException:
+                inflight.popleft()
+                scheduler.requeue(chunk, delivered)
+                raise
+            inflight.popleft()
+            elapsed = response.completed - max(response.started, lastcompleted)
+            scheduler.done(chunk, elapsed, response.size)
+            metrics.chunk(chunk, elapsed, response.size)
+            yield FetchedRange(*chunk)
+            lastcompleted = response.completed
+    finally:
+        # whatever is still in flight gets fetched again
+        for chunk, response in inflight:
+            scheduler.requeue(chunk)
+
+async def download_labels(gmail, last, skipped=None, done=(), labelsets=None):
+    # gmail doesn't like doing large fetches, so batch it up into chunks,
+    # and it gets cranky sometimes and just refuses to list some messages;
+    # by UID, so a resumed run still means the same messages
+    scheduler = FetchScheduler(last, skipped=skipped, done=done)
+    async for message in fetch_scheduled(gmail, scheduler, labelsets):
+        yield message
+    report_skipped(scheduler)
+
+async def download_labels_parallel(gmail, connections, folder, last, skipped=None, done=(), labelsets=None):
+    """
+    Same as download_labels, but spreads the chunks over several connections.
+
+    gmail is an already connected session with folder selected, further
+    ones are opened with connect_gmail().  Messages come back in no
+    particular order.
+    """
+    scheduler = FetchScheduler(last, skipped=skipped, done=done)
+    # bounded, so connections wait for the maildir instead of piling up messages
+    results = asyncio.Queue(connections * 4)
+    lasterror = None
+    async def worker(n, session):
+        nonlocal lasterror
+        # gmail limits the number of concurrent connections per account
+        # (and the rate of new ones), so back off when it pushes back
+        failures = 0
+        try:
+            while not scheduler.finished.is_set():
+                if session == None:
+                    try:
+                        # don't open them all at once
+                        await asyncio.wait_for(scheduler.finished.wait(), min(60, 2 ** failures) if failures else 0.5 * n)
+                    except asyncio.TimeoutError:
+                        pass
+                    if scheduler.finished.is_set():
+                        break
+                    try:
+                        session = await connect_gmail()
+                        await session.selectfolder(folder)
+                    except (imaplib.IMAP4.error, OSError, asyncio.TimeoutError) as err:
+                        if session != None:
+                            session.close()
+                        session = None
+                        failures += 1
+                        lasterror = err
+                        if config.DEBUG:
+                            print('connection %d: failed to connect (%s), attempt %d' % (n, err, failures))
+                        if failures >= 6:
+                            break
+                        continue
+                batch = []
+                try:
+                    async for message in fetch_scheduled(session, scheduler, labelsets):
+                        batch.append(message)
+                        if len(batch) >= 500:
+                            await results.put(batch)
+                            batch = []
+                            failures = 0
+                    await results.put(batch)
+                except (imaplib.IMAP4.abort, OSError) as err:
+                    # fetch_scheduled put the rest back for someone else to retry
+                    await results.put(batch)
+                    if session is not gmail:
+                        session.close()
+                    session = None
+                    failures += 1
+                    lasterror = err
+                    if config.DEBUG:
+                        print('connection %d: lost connection (%s), attempt %d' % (n, err, failures))
+                    if failures >= 6:
+                        break
+            await results.put(None)
+        except Exception as err:
+            await results.put(err)
+        finally:
+            if session != None and session is not gmail:
+                await session.logout()
+
+    workers = [asyncio.ensure_future(worker(n, gmail if n == 0 else None)) for n in range(connections)]
+
+    running = len(workers)
+    try:
+        while running > 0:
+            result = await results.get()
+            if result == None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                for message in result:
+                    yield message
+    finally:
+        # stop whoever is still waiting for work
+        scheduler.abort()
+        for task in workers:
+            task.cancel()
+    report_skipped(scheduler)
+
+    # some connections giving up is fine as long as the others did the work
+    if not scheduler.complete:
+        raise imaplib.IMAP4.error('all connections failed, last error: %s' % lasterror)
+
+async def download_changed_labels(gmail, modseq, last, skipped=None, retry=()):
+    """
+    like download_labels, but only for messages changed since modseq (needs
+    CONDSTORE), and the UIDs in retry, which an earlier sync had to skip
+    """
+    # the server does the filtering, the uid ranges just keep each response
+    # to a sane size in case a lot has changed; ranges gmail refuses are
+    # split up like in a full sync
+    scheduler = FetchScheduler(last, chunk_size=50000, skipped=skipped)
+    scheduler.max_size = scheduler.chunk_size
+    async for message in fetch_scheduled(gmail, scheduler, changedsince=modseq):
+        # nothing to checkpoint, the sync state covers it all at the end
+        if not isinstance(message, FetchedRange):
+            yield message
+    # there are few of these, and they likely get refused again
+    for uid in retry:
+        if uid in scheduler.skipped:
+            # refused along with the changed ones already
             continue
+        try:
+            async for message in gmail.fetch_labels('%d' % uid, uid=True):
+                report_missing_msgid(message)
+                yield message
+        except gmailimap.FetchRefused:
+            metrics.count('fetch_refused')
+            scheduler.skipped.append(uid)
+    report_skipped(scheduler)
+
+async def search_labels(gmail, total, known=()):
+    """
+    UID => labels of every message with labels, from a search per label, if
+    LABEL_STRATEGY says so, otherwise None to fetch them with each message.
+    Labels hidden from IMAP aren't listed, known adds ones seen before.
+    """
+    # searching misses labels hidden from IMAP, which would then be removed
+    strategy = getattr(config, 'LABEL_STRATEGY', 'fetch')
+    if strategy == 'fetch':
+        return None
+    with metrics.phase('search'):
+        labels = set(await gmail.list_labels())
+        labels.update(known)
+        if strategy == 'auto' and len(labels) * gmailimap.SEARCH_MESSAGES_PER_LABEL > total:
+            return None
+        print('searching %d labels' % len(labels))
+        return await gmail.label_sets(labels)
+
+async def connect_gmail():
+    gmail = await gmailimap.Gmail.connect(config.LOGIN, config.PASSWORD,
+        getattr(config, 'IMAP_SERVER', 'imap.gmail.com'),
+        getattr(config, 'IMAP_PORT', 993),
+        getattr(config, 'IMAP_CA_FILE', None),
+        compress=getattr(config, 'COMPRESS', True))
+    metrics.sessions.append(gmail)
+    return gmail
+
+def report_missing_msgid(message):
+    if message.msgid == None and (config.DEBUG or config.MESSAGE_DETAILS):
+        print('got message without Message-ID header: '
+              'gmail id %s, link: https://mail.google.com/mail/#all/%s'
+              % (message.gmailid, hex(int(message.thrid))[2:])
+        )
+
+def apply_batch(db, messages, counts, ranges=()):
+    """
+    applies the labels of some downloaded messages, counting what happened
+    in counts, then checkpoints the UID ranges those completed
+    """
+    with metrics.phase('apply'):
+        apply_messages(db, messages, counts)
+        if len(ranges) > 0:
+            db.add_swept(ranges)
+    metrics.count('messages_checked', len(messages))
+
+def apply_messages(db, messages, counts):
+    for message in messages:
+        counts['checked'] += 1
+        if counts['checked'] % 10 == 0 and os.isatty(1):
+            print('progress: %0.2f%% %d' % (float(counts['checked'] * 100 / counts['total']), counts['checked']), end='\r', flush=True)
+
+        # allow update by gmail id
+        updaterc = db.apply_labels(message.msgid, message.gmailid, message.thrid, message.labels)
+        if updaterc < 0:
+            counts['errors'] += 1
+            metrics.count('messages_not_found')
+        else:
+            counts['updated'] += updaterc
+            metrics.count('messages_updated', updaterc)
+
+class LabelPlan:
+    """
+    Stands in for the MaildirDatabase db in sync_folder, but only works out
+    what would change, and writes that to a plan file instead: a JSON line
+    per changed message, [key, gmailid, old labels, new labels], between a
+    header and a trailer line.  apply_plan carries it out later, so a slow
+    disk doesn't hold up the download, and a mass relabel can be looked at
+    before it happens.  The index isn't changed, not even the checkpoints.
+    """
+    VERSION = 1
+
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.changes = 0
+        # what apply_plan needs to bring the sync state along
+        self.trailer = dict(end=True, folder=None, base=None, sync_state=None, skipped=[], full=False)
+        self.__file = open(path + '.tmp', 'w')
+        self.__write(dict(plan=self.VERSION, maildir=config.MAILDIR, created=time.time()))
+
+    def __write(self, item):
+        self.__file.write(json.dumps(item) + '\n')
 
-        # every even (2, 4, 6, 8, ...) item from response should be b')'
-        for even_item in resp[1][1::2]:
-            assert even_item == b')'
+    def get_sync_state(self, folder):
+        state = self.db.get_sync_state(folder)
+        self.trailer['folder'] = folder
+        self.trailer['base'] = state
+        return state
 
-        # every odd (1, 3, 5, 7, ...) item should match regexp
-        for odd_item in resp[1][::2]:
-            imapid, gmailthreadid, gmailid, labels, payloadlen = regexp.match(odd_item[0].decode('utf-8')).groups()
+    def get_sweep(self, folder, uidvalidity):
+        # always the whole folder, an interrupted plan is just made again
+        return None
 
-            assert int(payloadlen) == len(odd_item[1])
+    def start_sweep(self, folder, uidvalidity, highestmodseq, last):
+        self.trailer['full'] = True
 
+    def add_swept(self, ranges):
+        pass
+
+    def finish_sweep(self):
+        pass
+
+    def set_sync_state(self, folder, uidvalidity, highestmodseq, skipped=()):
+        self.trailer['sync_state'] = (uidvalidity, highestmodseq)
+        self.trailer['skipped'] = sorted(skipped)
+
+    def get_skipped(self):
+        return self.db.get_skipped()
+
+    def known_labels(self):
+        return self.db.known_labels()
+
+    def apply_labels(self, msgid, gmailid, gmailthreadid, labels):
+        if self.db.labels_unchanged(gmailid, labels):
+            return 0
+        key = self.db.find_message(msgid, gmailid)
+        if key == None:
+            if config.DEBUG or config.MESSAGE_DETAILS:
+                print("no such message: '%s' / '%s'" % (msgid, gmailid))
+            return -1
+        old = self.db.message_labels(key)
+        if same_labels(old, labels):
+            return 0
+        self.__write([key, gmailid, old, labels])
+        self.changes += 1
+        return 1
+
+    def close(self):
+        """ finishes the plan file; until then there is none """
+        self.trailer['changes'] = self.changes
+        self.__write(self.trailer)
+        self.__file.close()
+        os.replace(self.path + '.tmp', self.path)
+
+def read_plan(path):
+    """ header, changes and trailer of a plan file, see LabelPlan """
+    with open(path) as f:
+        items = [json.loads(line) for line in f]
+    if len(items) < 2 or not isinstance(items[0], dict) or items[0].get('plan') != LabelPlan.VERSION \
+            or not isinstance(items[-1], dict) or not items[-1].get('end'):
+        raise ValueError('%s is not a complete label plan' % path)
+    return items[0], items[1:-1], items[-1]
+
+def apply_plan(db, path, workers):
+    """
+    Carries out a plan made with --plan.  If nothing was skipped, and nothing
+    else synced in the meantime, the sync state moves on to the plan's.
+    """
+    header, changes, trailer = read_plan(path)
+    if os.path.abspath(header['maildir']) != os.path.abspath(config.MAILDIR):
+        raise ValueError('%s is a plan for %s, not %s' % (path, header['maildir'], config.MAILDIR))
+    print('applying %d label changes planned %s' % (len(changes),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['created']))))
+    # two gmail messages with one Message-ID can both land on a key, the
+    # last one wins as it would have in a sync
+    changes = list({change[0]: change for change in changes}.values())
+    with metrics.phase('apply'):
+        applied, stale = db.apply_planned(changes, workers)
+    metrics.count('messages_updated', applied)
+    print('applied %d, skipped %d that changed or went away since the plan' % (applied, stale))
+
+    base = trailer['base']
+    if trailer['sync_state'] != None and stale == 0 and \
+            db.get_sync_state(trailer['folder']) == (tuple(base) if base != None else None):
+        db.set_sync_state(trailer['folder'], *trailer['sync_state'], trailer.get('skipped', ()))
+        if trailer['full']:
+            db.finish_sweep()
+        print('sync state moved on to the plan\'s')
+    return applied
+
+async def sync_labels(db, counts, writer=None):
+    print('connecting to gmail')
+    with metrics.phase('connect'):
+        gmail = await connect_gmail()
+    try:
+        #gmail.debug = 15;
+        await sync_folder(gmail, db, counts, writer)
+    finally:
+        await gmail.logout()
+
+async def sync_folder(gmail, db, counts, writer=None):
+    """
+    brings the labels in db up to date with config.IMAP_FOLDER, over a
+    connected gmail; the maildir is written in a thread of writer, or of
+    one of its own if none is given
+    """
+    print('selecting mailbox')
+    with metrics.phase('connect'):
+        counts['total'] = await gmail.selectfolder(config.IMAP_FOLDER)
+
+    # new messages in the maildir already carry the labels they had when
+    # they were downloaded, and any later change bumps their modseq, so
+    # only messages changed since the last complete sync need fetching
+    skipped = []
+    syncstate = db.get_sync_state(config.IMAP_FOLDER)
+    if not getattr(config, 'INCREMENTAL', True) or gmail.highestmodseq == None:
+        syncstate = None
+    elif syncstate != None and syncstate[0] != gmail.uidvalidity:
+        print('UIDVALIDITY changed, doing a full sync')
+        syncstate = None
+
+    if syncstate != None and syncstate[1] == gmail.highestmodseq and len(db.get_skipped()) == 0:
+        print('no label changes since the last sync')
+        return
+    modseq = gmail.highestmodseq
+    if syncstate != None:
+        print('downloading and applying labels changed since modseq %d' % syncstate[1])
+        retry = db.get_skipped()
+        if len(retry) > 0:
+            print('retrying %d messages gmail refused before' % len(retry))
+        messages = download_changed_labels(gmail, syncstate[1], await gmail.last_uid(), skipped, retry)
+    else:
+        # a full sync is checkpointed as it goes, and picks up where the
+        # last one left off if that was interrupted
+        sweep = db.get_sweep(config.IMAP_FOLDER, gmail.uidvalidity)
+        if sweep != None:
+            modseq, last, done = sweep
+            print('resuming interrupted full sync, %d of %d UIDs already done' %
+                (sum(end - first + 1 for first, end in done), last))
+        else:
+            last = await gmail.last_uid()
+            done = []
+            db.start_sweep(config.IMAP_FOLDER, gmail.uidvalidity, modseq, last)
+        labelsets = await search_labels(gmail, counts['total'], db.known_labels())
+        print('downloading and applying labels for %d messages' % counts['total'])
+        connections = getattr(config, 'CONNECTIONS', 1)
+        if connections > 1:
+            messages = download_labels_parallel(gmail, connections,
+                config.IMAP_FOLDER, last, skipped, done, labelsets)
+        else:
+            messages = download_labels(gmail, last, skipped, done, labelsets)
+
+    # the maildir is written in another thread, one batch at a time, while
+    # the next batch is downloaded
+    loop = asyncio.get_running_loop()
+    with metrics.phase('fetch'), (concurrent.futures.ThreadPoolExecutor(1) if writer == None
+            else contextlib.nullcontext(writer)) as writer:
+        applying = None
+        batch = []
+        # fully downloaded, to be checkpointed with the batch
+        ranges = []
+        async for message in messages:
+            if isinstance(message, FetchedRange):
+                ranges.append(message)
+                continue
+            batch.append(message)
+            if len(batch) >= 200:
+                if applying != None:
+                    await applying
+                applying = loop.run_in_executor(writer, contextvars.copy_context().run,
+                    apply_batch, db, batch, counts, ranges)
+                batch = []
+                ranges = []
+        if applying != None:
+            await applying
+        apply_batch(db, batch, counts, ranges)
+
+    # what gmail refused is remembered and retried by the next runs, so
+    # one bad message doesn't keep the rest from syncing incrementally
+    if modseq != None:
+        db.set_sync_state(config.IMAP_FOLDER, gmail.uidvalidity, modseq, skipped)
+    if syncstate == None:
+        db.finish_sweep()
+
+async def watch_labels(db, counts, jobs):
+    """
+    Keeps the labels up to date until stopped: waits in IDLE for gmail to
+    report changes to the folder, then fetches just the labels that changed
+    since the last sync.  gmail doesn't report every label change while
+    idling, so that is also done every WATCH_IDLE seconds anyway, and every
+    WATCH_RECONCILE seconds the maildir is rescanned for new messages.
+    """
+    idletime = getattr(config, 'WATCH_IDLE', 300)
+    reconcile = getattr(config, 'WATCH_RECONCILE', 3600)
+    # stop cleanly on ^C or a kill, the database still needs closing
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+
+    failures = 0
+    lastscan = time.time()
+    try:
+        while True:
+            gmail = None
             try:
-                msgid = odd_item[1].decode('utf-8').split()[1]
-            except IndexError:
-                if config.DEBUG or config.MESSAGE_DETAILS:
-                    print('got message without Message-ID header: '
-                          'gmail id %s, link: https://mail.google.com/mail/#all/%s'
-                          % (gmailid, hex(int(gmailthreadid))[2:])
-                    )
-                #continue
-                # allow update by gmail id
-                msgid = None
+                print('connecting to gmail')
+                with metrics.phase('connect'):
+                    gmail = await connect_gmail()
+                if not gmail.condstore:
+                    raise imaplib.IMAP4.error('--watch needs a server with CONDSTORE')
+                while True:
+                    if time.time() - lastscan >= reconcile:
+                        print('rescanning maildir')
+                        with metrics.phase('index'):
+                            for progress in db.init(jobs):
+                                pass
+                        lastscan = time.time()
+                    await sync_folder(gmail, db, counts)
+                    metrics.write()
+                    failures = 0
+                    with metrics.phase('idle'):
+                        news = await gmail.idle(idletime)
+                    if config.DEBUG:
+                        print('gmail says: %s' % news)
+            except (imaplib.IMAP4.error, OSError, asyncio.TimeoutError) as err:
+                # gmail drops connections now and then, networks go away,
+                # and it refuses commands it took a minute ago
+                if gmail != None and not gmail.condstore:
+                    # that won't change by trying again
+                    raise
+                failures += 1
+                delay = min(300, 2 ** failures)
+                print('connection to gmail failed (%s), reconnecting in %d seconds' % (err, delay))
+                metrics.count('reconnects')
+                await asyncio.sleep(delay)
+            finally:
+                if gmail != None:
+                    gmail.close()
+    except asyncio.CancelledError:
+        print('stopping')
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+def load_config(cfgname, modname='config'):
+    """ a config module, from a file or by module name """
+    if os.path.isfile(cfgname):
+        return importlib.machinery.SourceFileLoader(modname, cfgname).load_module()
+    return importlib.import_module(cfgname)
 
-            yield msgid, gmailid, gmailthreadid, labels
+async def sync_account(name, cfg, args, status, connections, indexers, writers):
+    """ one account of sync_accounts, in a context of its own """
+    current_account.set(name)
+    current_config.set(cfg)
+    current_metrics.set(Metrics())
+    metrics.start()
+    loop = asyncio.get_running_loop()
+    counts = dict(total=0, updated=0, checked=0, errors=0)
+    status[name] = dict(state='indexing', counts=counts, error=None, seconds=None)
+    started = time.time()
+
+    def index():
+        print('opening maildir')
+        db = MaildirDatabase(config.MAILDIR)
+        try:
+            with metrics.phase('index'):
+                for progress in db.init(args.jobs, args.rescan):
+                    pass
+            if args.verify:
+                with metrics.phase('verify'):
+                    for progress in db.verify_labels():
+                        pass
+        except BaseException:
+            db.close()
+            raise
+        return db
+
+    db = None
+    try:
+        # indexing is mostly reading files, only so many at once
+        db = await loop.run_in_executor(indexers, contextvars.copy_context().run, index)
+        counts['total'] = db.message_count()
+        if not config.INDEX_ONLY:
+            status[name]['state'] = 'waiting'
+            async with connections:
+                status[name]['state'] = 'syncing'
+                await sync_labels(db, counts, writers)
+        status[name]['state'] = 'done'
+    except Exception as err:
+        # the other accounts carry on
+        status[name]['state'] = 'failed'
+        status[name]['error'] = '%s: %s' % (type(err).__name__, err)
+        if isinstance(err, imaplib.IMAP4.error):
+            metrics.count('imap_failures')
+        print('failed: %s' % status[name]['error'])
+    finally:
+        if db != None:
+            print('Updated %d/%d messages, %d errors' % (counts['updated'], counts['checked'], counts['errors']))
+            db.close()
+        metrics.finish()
+        status[name]['seconds'] = time.time() - started
+
+def sync_accounts(cfgnames, args):
+    """
+    Syncs several accounts in one process.  Talking to gmail is mostly
+    waiting, so args.parallel accounts do that at once; indexing reads a
+    lot of files, so only args.index_workers accounts index at a time, and
+    the labels of all of them are written by args.write_workers threads.
+    Prints a summary at the end, returns 1 if any of them failed.
+    """
+    global config, metrics
+    configs = [(cfgname, load_config(cfgname, 'config%d' % n)) for n, cfgname in enumerate(cfgnames)]
+    config = ContextProxy(current_config)
+    metrics = ContextProxy(current_metrics)
+    status = collections.OrderedDict()
+
+    async def run():
+        connections = asyncio.Semaphore(args.parallel)
+        await asyncio.gather(*(sync_account(name, cfg, args, status, connections, indexers, writers)
+            for name, cfg in configs))
+
+    sys.stdout = AccountOutput(sys.stdout)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(args.index_workers) as indexers, \
+                concurrent.futures.ThreadPoolExecutor(args.write_workers) as writers:
+            asyncio.run(run())
+    finally:
+        sys.stdout = sys.stdout.out
+
+    print('%-30s %-8s %9s %9s %7s %9s' % ('account', 'result', 'checked', 'updated', 'errors', 'seconds'))
+    totals = collections.Counter()
+    for name, cfg in configs:
+        account = status.get(name, dict(state='not run', counts={}, error=None, seconds=None))
+        counts = account['counts']
+        print('%-30s %-8s %9d %9d %7d %9s' % (name, account['state'], counts.get('checked', 0),
+            counts.get('updated', 0), counts.get('errors', 0),
+            '%.1f' % account['seconds'] if account['seconds'] != None else '-'))
+        if account['error'] != None:
+            print('    %s' % account['error'])
+        totals.update(counts)
+        totals[account['state']] += 1
+    print('%d accounts: %d done, %d failed; %d messages checked, %d updated, %d errors' % (len(configs),
+        totals['done'], totals['failed'], totals['checked'], totals['updated'], totals['errors']))
+    return 1 if totals['done'] < len(configs) else 0
 
 def main():
-    cfgname = sys.argv[1]
-    if cfgname == None:
-    	cfgname = 'config'
+    parser = argparse.ArgumentParser(description='Download gmail labels and apply them to a local Maildir copy.')
+    parser.add_argument('config', nargs='*', default=['config'],
+        help='config module names or files, several sync several accounts at once (default: config)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of processes to index new messages with (default: %(default)s)')
+    parser.add_argument('--rescan', action='store_true',
+        help='list the whole maildir, even the directories that look unchanged since the last run')
+    parser.add_argument('--verify', action='store_true',
+        help='check the cached labels against the message files before syncing')
+    parser.add_argument('--watch', action='store_true',
+        help='keep running, applying label changes as gmail reports them')
+    parser.add_argument('--export-labels', action='store_true',
+        help='write the labels kept in the sidecar (LABEL_STORE = \'sidecar\') into the message files and exit')
+    parser.add_argument('--parallel', type=int, default=8,
+        help='with several configs, how many accounts talk to gmail at once (default: %(default)s)')
+    parser.add_argument('--index-workers', type=int, default=1,
+        help='with several configs, how many accounts index their maildir at once (default: %(default)s)')
+    parser.add_argument('--write-workers', type=int, default=2,
+        help='threads writing labels to the maildirs, with several configs or --apply-plan (default: %(default)s)')
+    parser.add_argument('--plan', metavar='FILE',
+        help='download the labels and write the changes to FILE, without touching the maildir')
+    parser.add_argument('--apply-plan', metavar='FILE',
+        help='apply the changes in a FILE written by --plan and exit')
+    args = parser.parse_args()
+
+    if args.plan != None and (args.apply_plan != None or args.watch):
+        parser.error('--plan goes with neither --apply-plan nor --watch')
+    if len(args.config) > 1:
+        if args.watch or args.export_labels or args.plan != None or args.apply_plan != None:
+            parser.error('--watch, --export-labels, --plan and --apply-plan take a single config')
+        return sync_accounts(args.config, args)
+
     global config
-    if os.path.isfile(cfgname):
-    	config = importlib.machinery.SourceFileLoader('config', cfgname).load_module()
-    else:
-    	config = importlib.import_module(cfgname)
+    config = load_config(args.config[0])
     
+    metrics.start()
+
     print('opening maildir')
     db = MaildirDatabase(config.MAILDIR)
 
-    total = len(db)
+    # the first time around there is no list of files yet
+    total = db.message_count() or len(db)
 
-    updated_msgs = 0
-    checked_msgs = 0
-    errors = 0
+    # updated by apply_batch as the labels come in
+    counts = dict(total=total, updated=0, checked=0, errors=0)
     
     try:
         print('searching for new messages')
 
-        for progress in db.init():
-            if os.isatty(1):
-                print('progress: %0.2f%%' % float(progress * 100 / total), end='\r', flush=True)
+        with metrics.phase('index'):
+            for progress in db.init(args.jobs, args.rescan):
+                if os.isatty(1):
+                    print('progress: %0.2f%%' % float(progress * 100 / max(total, 1)), end='\r', flush=True)
+
+        if args.verify:
+            print('verifying cached labels')
+            with metrics.phase('verify'):
+                for progress in db.verify_labels():
+                    if os.isatty(1):
+                        print('progress: %0.2f%%' % float(progress * 100 / total), end='\r', flush=True)
         
-        if config.INDEX_ONLY:
-            print('indexing complete')
+        if args.export_labels:
+            print('exporting labels')
+            with metrics.phase('export'):
+                for progress in db.export_labels():
+                    if os.isatty(1):
+                        print('progress: %d' % progress, end='\r', flush=True)
             return
 
-        print('connecting to gmail')
-        gmail = Gmail(config.LOGIN, config.PASSWORD)
-
-        #gmail.debug = 15;
-
-        print('selecting mailbox')
-        total = gmail.selectfolder(config.IMAP_FOLDER)
-        i = 0
+        if args.apply_plan != None:
+            print('applying %s' % args.apply_plan)
+            try:
+                counts['updated'] = counts['checked'] = apply_plan(db, args.apply_plan, args.write_workers)
+            except ValueError as err:
+                print(err, file=sys.stderr)
+                return 1
+            return
 
-        print('downloading and applying labels for %d messages' % total)
-        for msgid, gmailid, gmailthreadid, labels in download_labels(gmail, total):
-            checked_msgs += 1
-            i += 1
-            if i % 10 == 0 and os.isatty(1):
-                print('progress: %0.2f%% %d' % (float(i * 100 / total), checked_msgs), end='\r', flush=True)
+        if config.INDEX_ONLY:
+            print('indexing complete')
+            return
 
-            updaterc = db.apply_labels(msgid, gmailid, gmailthreadid, labels)
-            if updaterc < 0:
-                errors += 1
-            else:
-                updated_msgs += updaterc
+        if args.watch:
+            asyncio.run(watch_labels(db, counts, args.jobs))
+        elif args.plan != None:
+            plan = LabelPlan(db, args.plan)
+            asyncio.run(sync_labels(plan, counts))
+            plan.close()
+            print('planned %d label changes in %s' % (plan.changes, args.plan))
+        else:
+            asyncio.run(sync_labels(db, counts))
     except imaplib.IMAP4.error as err:
         print('\nFailed with imap error:', file=sys.stderr)
         print(err, file=sys.stderr)
+        metrics.count('imap_failures')
     finally:
-        print('Updated %d/%d messages, %d errors' % (updated_msgs, checked_msgs, errors))
+        print('Updated %d/%d messages, %d errors' % (counts['updated'], counts['checked'], counts['errors']))
         # extra whitespace at end to ensure it fully overwrites progress line
         print('saving database ')
         db.close()
+        metrics.finish()
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,702 @@
+"""
+asyncio gmail client shared by gmail-sync-labels.py and gmail-restore-labels.py
+
+Commands are sent as soon as they are issued and the responses are sorted
+out as they arrive, so any number of them can be in flight on one
+connection.  Errors are the ones imaplib uses, so callers can catch
+imaplib.IMAP4.error and imaplib.IMAP4.abort like before.
+"""
+
+import asyncio
+import collections
+import imaplib
+import io
+import itertools
+import re
+import ssl
+import time
+import zlib
+
+# what a label fetch yields per message, all str except seq and uid (int),
+# msgid is None for messages without a Message-ID header (or when it wasn't
+# asked for), labels None when they weren't asked for
+FetchedMessage = collections.namedtuple('FetchedMessage', 'seq gmailid thrid labels msgid uid')
+
+LABEL_ITEMS = 'UID X-GM-THRID X-GM-MSGID X-GM-LABELS BODY[HEADER.FIELDS (MESSAGE-ID)]'
+ID_ITEMS = 'UID X-GM-THRID X-GM-MSGID'
+
+# searching each label beats fetching every message's labels once there
+# are at least this many messages per label
+SEARCH_MESSAGES_PER_LABEL = 1000
+
+# how many messages of a FETCH may wait to be read before the connection
+# stops reading, so a slow reader doesn't end up with whole ranges in memory
+FETCH_BUFFER = 1000
+
+# gmail's special folders (RFC 6154 special-use) => the label they stand for,
+# None for the ones that aren't labels or whose messages aren't in All Mail
+_special_labels = {b'\\sent': '\\Sent', b'\\flagged': '\\Starred', b'\\important': '\\Important',
+    b'\\drafts': '\\Draft', b'\\all': None, b'\\trash': None, b'\\junk': None, b'\\noselect': None}
+
+class FetchRefused(imaplib.IMAP4.error):
+    """ the server answered NO, some messages may have been returned before that """
+
+_fetch_re = re.compile(rb'\* (\d+) FETCH ')
+_exists_re = re.compile(rb'\* (\d+) EXISTS')
+_list_re = re.compile(rb'\* LIST \(([^)]*)\) ')
+_search_re = re.compile(rb'\* SEARCH\b')
+_code_re = re.compile(rb'\* OK \[(UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (\d+)\]')
+_news_re = re.compile(rb'\* \d+ (EXISTS|EXPUNGE|FETCH|RECENT)')
+_literal_re = re.compile(rb'\{(\d+)\+?\}$')
+_quoted_re = re.compile(rb'"((?:[^"\\]|\\.)*)"')
+_unescape_re = re.compile(rb'\\(.)')
+# atoms, including flags like \Inbox and sections like BODY[HEADER.FIELDS (MESSAGE-ID)]
+_atom_re = re.compile(rb'(?:[^\s()"{\[\]]|\[[^\]]*\])+(?:<\d+>)?')
+# the usual shape of an attribute in a label fetch: a number, a list with
+# no lists in it, or a literal; anything else goes through _Reader.value
+_attribute_re = re.compile(rb' *([A-Za-z0-9.\-]+(?:\[[^\]]*\])?) (?:(\d+)|(\((?:[^()"{]|"(?:[^"\\]|\\.)*")*\))|\{(\d+)\+?\}$)')
+# the plain items of a FETCH, not BODY[...] sections
+_item_re = re.compile(r'^[A-Za-z0-9.\-]+$')
+_label_re = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s"]+)')
+_label_unescape_re = re.compile(r'\\(.)')
+_safe_label_re = re.compile(r'^[^\s()"{\\%*\[\]]+$')
+
+class _Reader:
+    """ parses one response out of source, a line and any literals at a time """
+    def __init__(self, source):
+        self.source = source
+        self.line = b''
+        self.pos = 0
+        self.size = 0
+
+    def next_line(self):
+        line = self.source.readline()
+        if not line.endswith(b'\r\n'):
+            raise imaplib.IMAP4.abort('connection closed in the middle of a response')
+        self.size += len(line)
+        self.line = line[:-2]
+        self.pos = 0
+
+    def literal(self, size=None):
+        """ reads the literal announced at the end of the current line, if any """
+        if size == None:
+            m = _literal_re.search(self.line, self.pos)
+            if m == None:
+                return None
+            size = int(m.group(1))
+        data = self.source.read(size)
+        if len(data) != size:
+            raise imaplib.IMAP4.abort('connection closed in the middle of a literal')
+        self.size += len(data)
+        # the response goes on after the literal as if it was a new line
+        self.next_line()
+        return data
+
+    def skip_spaces(self):
+        while self.line[self.pos:self.pos + 1] == b' ':
+            self.pos += 1
+
+    def value(self):
+        self.skip_spaces()
+        c = self.line[self.pos:self.pos + 1]
+        if c == b'(':
+            self.pos += 1
+            items = []
+            while True:
+                self.skip_spaces()
+                if self.line[self.pos:self.pos + 1] == b')':
+                    self.pos += 1
+                    return items
+                items.append(self.value())
+        if c == b'"':
+            m = _quoted_re.match(self.line, self.pos)
+        elif c == b'{':
+            m = _literal_re.match(self.line, self.pos)
+            if m != None:
+                return self.literal()
+        else:
+            m = _atom_re.match(self.line, self.pos)
+        if m == None:
+            raise imaplib.IMAP4.error('unexpected response %r' % self.line[self.pos:self.pos + 100])
+        self.pos = m.end()
+        if c == b'"':
+            return _unescape_re.sub(rb'\1', m.group(1))
+        return m.group(0)
+
+    def attributes(self):
+        """
+        the parenthesized attribute list of a FETCH response, as a dict of
+        upper case name => value, except that X-GM-LABELS is kept as the raw
+        text of the list, the way gmail sent it
+        """
+        self.skip_spaces()
+        if self.line[self.pos:self.pos + 1] != b'(':
+            raise imaplib.IMAP4.error('unexpected response %r' % self.line[:100])
+        self.pos += 1
+        attrs = dict()
+        while True:
+            self.skip_spaces()
+            if self.line[self.pos:self.pos + 1] == b')':
+                self.pos += 1
+                return attrs
+            m = _attribute_re.match(self.line, self.pos)
+            if m != None:
+                name, number, parens, literal = m.groups()
+                name = name.upper()
+                if number != None:
+                    self.pos = m.end()
+                    attrs[name] = number
+                    continue
+                if literal != None:
+                    self.pos = m.end()
+                    attrs[name] = self.literal(int(literal))
+                    continue
+                if name == b'X-GM-LABELS':
+                    self.pos = m.end()
+                    attrs[name] = parens[1:-1]
+                    continue
+            name = self.value().upper()
+            self.skip_spaces()
+            if name == b'X-GM-LABELS':
+                line, start = self.line, self.pos
+                value = self.value()
+                if self.line is line:
+                    value = line[start + 1:self.pos - 1]
+                else:
+                    # a label came as a literal, quote it like the rest
+                    value = b' '.join(quote_label(label.decode('utf-8', 'surrogateescape')).encode('utf-8', 'surrogateescape')
+                        for label in value)
+            else:
+                value = self.value()
+            attrs[name] = value
+
+def _fetched_message(seq, attrs):
+    header = b''
+    for name, value in attrs.items():
+        if name.startswith(b'BODY['):
+            header = value
+    header = header.split()
+    labels = attrs.get(b'X-GM-LABELS')
+    return FetchedMessage(seq,
+        attrs[b'X-GM-MSGID'].decode('ascii'),
+        attrs[b'X-GM-THRID'].decode('ascii'),
+        labels.decode('utf-8', 'surrogateescape') if labels != None else None,
+        header[1].decode('utf-8', 'surrogateescape') if len(header) > 1 else None,
+        int(attrs[b'UID']))
+
+def split_labels(labels):
+    """ the label names in the raw text of an X-GM-LABELS list """
+    return [_label_unescape_re.sub(r'\1', quoted) if quoted else atom
+        for quoted, atom in _label_re.findall(labels)]
+
+def quote_label(label):
+    """ label name => astring, quoted if it has to be """
+    if _safe_label_re.match(label):
+        return label
+    return '"' + label.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def quote_string(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def parse_set(msgset):
+    """ '1:3,7,9:*' => [(1, 3), (7, 7), (9, inf)], '*' => [(1, inf)] """
+    ranges = []
+    for part in msgset.split(','):
+        if part == '*':
+            # the last message, whatever its number
+            ranges.append((1, float('inf')))
+            continue
+        first, _, last = part.partition(':')
+        first = float('inf') if first == '*' else int(first)
+        last = first if last == '' else float('inf') if last == '*' else int(last)
+        ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+class _Command:
+    """ a command on its way, until its tagged response comes back """
+    def __init__(self, name, ranges=None, uid=False, items=()):
+        self.name = name
+        # resolves to (status, text) of the tagged response
+        self.done = asyncio.get_running_loop().create_future()
+        # untagged responses other than FETCH that arrived while this was the oldest command
+        self.untagged = []
+        # for FETCH, which messages it asked for, so its responses can be told apart
+        # from those of the other fetches in flight, and where they go from here
+        self.ranges = ranges
+        self.uid = uid
+        # and what it asked for, which unsolicited FETCH responses about the
+        # same messages, e.g. flags changed by another client, don't have
+        self.items = items
+        self.messages = asyncio.Queue() if ranges != None else None
+        # set while the reader keeps up, see FETCH_BUFFER; not any more once
+        # another kind of command is sent, its caller may wait for that first
+        self.drained = asyncio.Event() if ranges != None else None
+        self.bounded = ranges != None
+        if self.drained != None:
+            self.drained.set()
+        self.size = 0
+        self.started = time.time()
+        self.completed = None
+        # for IDLE, resolves on the server's go ahead, and is set on any news
+        self.continued = None
+        self.news = None
+
+    def wants(self, seq, attrs):
+        for item in self.items:
+            if item not in attrs:
+                return False
+        if self.uid:
+            if b'UID' not in attrs:
+                return False
+            seq = int(attrs[b'UID'])
+        for first, last in self.ranges:
+            if first <= seq <= last:
+                return True
+        return False
+
+    def finish(self, status, text):
+        self.completed = time.time()
+        if not self.done.done():
+            self.done.set_result((status, text))
+        if self.messages != None:
+            self.messages.put_nowait(None)
+
+    def fail(self, err):
+        if not self.done.done():
+            self.done.set_exception(err)
+            # whoever waits for it still gets the error, but nobody has to,
+            # e.g. the fetches behind one that failed
+            self.done.exception()
+        if self.messages != None:
+            self.messages.put_nowait(None)
+            self.unbound()
+        if self.continued != None and not self.continued.done():
+            self.continued.cancel()
+        if self.news != None:
+            self.news.set()
+
+    def unbound(self):
+        self.bounded = False
+        self.drained.set()
+
+class FetchResponse:
+    """
+    Async iterator over the messages a FETCH returns, as they come in.
+
+    The command is already on its way when this is created.  Yields
+    (seq, attributes), see _Reader.attributes, or whatever convert makes of
+    them.  Raises FetchRefused if the server says NO, which gmail does for
+    messages it can't fetch.  size is the number of bytes received so far,
+    started and completed when it was sent and when it was done.
+
+    Once FETCH_BUFFER messages are waiting here, nothing more is read from
+    the connection until some are taken, unless a command other than FETCH
+    was sent after this one.
+    """
+    def __init__(self, command, convert=None):
+        self.__command = command
+        self.__convert = convert
+        self.__finished = False
+
+    @property
+    def size(self):
+        return self.__command.size
+
+    @property
+    def started(self):
+        return self.__command.started
+
+    @property
+    def completed(self):
+        return self.__command.completed
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.__finished:
+            raise StopAsyncIteration
+        item = await self.__command.messages.get()
+        if self.__command.messages.qsize() < FETCH_BUFFER // 2:
+            self.__command.drained.set()
+        if item == None:
+            self.__finished = True
+            status, text = await self.__command.done
+            if status == 'OK':
+                raise StopAsyncIteration
+            if status == 'NO':
+                raise FetchRefused('%s failed: %s' % (self.__command.name, text))
+            raise imaplib.IMAP4.error('%s failed: %s %s' % (self.__command.name, status, text))
+        if self.__convert != None:
+            return self.__convert(*item)
+        return item
+
+class Gmail:
+    """
+    A connection to gmail, open one with Gmail.connect().
+
+    After selectfolder(), uidvalidity, uidnext and highestmodseq hold what
+    the server said about the folder (None if it didn't).  bytes_sent,
+    bytes_received and commands count the traffic so far, as it went over
+    the wire; raw_bytes_sent and raw_bytes_received the same before
+    COMPRESS=DEFLATE, if the connection uses it (compressed is true then).
+    """
+    def __init__(self, reader, writer, timeout):
+        self.__reader = reader
+        self.__writer = writer
+        # received, but not dispatched yet
+        self.__buffer = bytearray()
+        # how long to wait for the server while something is in flight
+        self.timeout = timeout
+        self.__tags = itertools.count(1)
+        # tag => _Command, oldest first
+        self.__pending = dict()
+        self.__dispatcher = None
+        # what broke the connection, once it is broken
+        self.__error = None
+        self.capabilities = set()
+        self.condstore = False
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestmodseq = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.raw_bytes_sent = 0
+        self.raw_bytes_received = 0
+        self.commands = 0
+        # zlib streams once COMPRESS=DEFLATE is on
+        self.compressed = False
+        self.__deflate = None
+        self.__inflate = None
+
+    @classmethod
+    async def connect(cls, login, password, host='imap.gmail.com', port=993, cafile=None, timeout=30.0, compress=True):
+        # verifies the certificate and hostname against the system CA store,
+        # or against cafile if given (e.g. for a local test server)
+        ctx = ssl.create_default_context(cafile=cafile)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ctx, limit=1 << 20), timeout)
+        gmail = cls(reader, writer, timeout)
+        try:
+            greeting = await asyncio.wait_for(reader.readline(), timeout)
+            gmail.bytes_received += len(greeting)
+            gmail.raw_bytes_received += len(greeting)
+            if not greeting.startswith(b'* OK'):
+                raise imaplib.IMAP4.error('unexpected greeting from %s: %r' % (host, greeting[:100]))
+            gmail.__dispatcher = asyncio.ensure_future(gmail.__dispatch())
+
+            await gmail.check('LOGIN', quote_string(login), quote_string(password))
+            for line in await gmail.check('CAPABILITY'):
+                if line.startswith(b'* CAPABILITY '):
+                    gmail.capabilities.update(line[13:].decode('ascii', 'replace').upper().split())
+            if 'X-GM-EXT-1' not in gmail.capabilities:
+                raise imaplib.IMAP4.error('%s does not look like gmail, it has no X-GM-EXT-1' % host)
+
+            # with CONDSTORE enabled the server reports HIGHESTMODSEQ on select,
+            # which lets us ask for just the messages changed since the last run
+            gmail.condstore = 'CONDSTORE' in gmail.capabilities and 'ENABLE' in gmail.capabilities
+            if gmail.condstore:
+                await gmail.check('ENABLE', 'CONDSTORE')
+
+            # label lists and Message-IDs compress well; without it, or if
+            # the server says NO after all, everything just goes uncompressed
+            if compress and 'COMPRESS=DEFLATE' in gmail.capabilities:
+                await gmail.send('COMPRESS', 'DEFLATE')
+        except BaseException:
+            gmail.close()
+            raise
+        return gmail
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.logout()
+
+    def send(self, *words):
+        """
+        Sends a command right away, returns a future of the (status, text)
+        of its tagged response.  Anything else sent before that resolves is
+        pipelined behind it.
+        """
+        return self.__send(words).done
+
+    def __send(self, words, ranges=None, uid=False, items=()):
+        if self.__error != None:
+            raise imaplib.IMAP4.abort('connection is gone: %s' % self.__error)
+        tag = b'A%d' % next(self.__tags)
+        if ranges == None:
+            # whoever sends this may wait for it before reading the fetches
+            # in flight, whose responses come first
+            for pending in self.__pending.values():
+                if pending.bounded:
+                    pending.unbound()
+        command = _Command(words[0], ranges, uid, items)
+        self.__pending[tag] = command
+        self.__write(tag + b' ' + ' '.join(words).encode('utf-8') + b'\r\n')
+        self.commands += 1
+        return command
+
+    def __write(self, data):
+        self.raw_bytes_sent += len(data)
+        if self.__deflate != None:
+            # flushed every time, the server has to see each command whole
+            data = self.__deflate.compress(data) + self.__deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.__writer.write(data)
+        self.bytes_sent += len(data)
+
+    async def check(self, *words):
+        """ sends a command and waits for it, raising unless it went OK; returns its untagged responses """
+        command = self.__send(words)
+        status, text = await command.done
+        if status != 'OK':
+            raise imaplib.IMAP4.error('%s failed: %s %s' % (words[0], status, text))
+        return command.untagged
+
+    def fetch(self, msgset, items, uid=False, changedsince=None, convert=None):
+        """ FetchResponse for items of the messages in msgset, a uid set if uid is true """
+        words = ['UID', 'FETCH'] if uid else ['FETCH']
+        words += [msgset, '(%s)' % items]
+        if changedsince != None:
+            words.append('(CHANGEDSINCE %d)' % changedsince)
+        names = [item.upper().encode('ascii') for item in items.split() if _item_re.match(item)]
+        return FetchResponse(self.__send(words, parse_set(msgset), uid, names), convert)
+
+    def fetch_labels(self, msgset, uid=False, changedsince=None):
+        """ FetchResponse yielding a FetchedMessage for each message in msgset """
+        return self.fetch(msgset, LABEL_ITEMS, uid, changedsince, _fetched_message)
+
+    def fetch_ids(self, msgset, uid=False, msgid=False):
+        """ like fetch_labels, but without the labels, and without the Message-ID unless msgid """
+        items = ID_ITEMS + ' BODY[HEADER.FIELDS (MESSAGE-ID)]' if msgid else ID_ITEMS
+        return self.fetch(msgset, items, uid, None, _fetched_message)
+
+    async def list_labels(self):
+        """ the labels that show up in IMAP, named the way X-GM-LABELS names them """
+        labels = []
+        for line in await self.check('LIST', '""', '"*"'):
+            m = _list_re.match(line)
+            if m == None:
+                continue
+            reader = _Reader(io.BytesIO(line[m.end():] + b'\r\n'))
+            reader.next_line()
+            delimiter = reader.value()
+            name = reader.value().decode('utf-8', 'surrogateescape')
+            flags = m.group(1).lower().split()
+            special = [_special_labels[flag] for flag in flags if flag in _special_labels]
+            if len(special) > 0:
+                if special[0] != None:
+                    labels.append(special[0])
+            elif name.upper() == 'INBOX':
+                labels.append('\\Inbox')
+            elif not name.startswith('[Gmail]' + delimiter.decode('ascii', 'replace')):
+                labels.append(name)
+        return labels
+
+    async def label_sets(self, labels):
+        """
+        UID => raw X-GM-LABELS text for the messages in the selected folder
+        that have any of labels, found with a UID SEARCH per label, all in
+        flight together.  Labels are sorted, messages without any left out.
+        """
+        labels = sorted(set(labels))
+        commands = [self.__send(('UID', 'SEARCH', 'X-GM-LABELS', quote_string(label))) for label in labels]
+        bymessage = collections.defaultdict(list)
+        for label, command in zip(labels, commands):
+            status, text = await command.done
+            # a label that doesn't exist (any more) just has no messages
+            if status == 'NO':
+                continue
+            if status != 'OK':
+                raise imaplib.IMAP4.error('SEARCH failed: %s %s' % (status, text))
+            quoted = quote_label(label)
+            for line in command.untagged:
+                if _search_re.match(line) != None:
+                    for uid in line[8:].split():
+                        bymessage[int(uid)].append(quoted)
+        return dict((uid, ' '.join(quoted)) for uid, quoted in bymessage.items())
+
+    async def selectfolder(self, folder, readonly=True):
+        total = None
+        self.uidvalidity = self.uidnext = self.highestmodseq = None
+        for line in await self.check('EXAMINE' if readonly else 'SELECT', folder):
+            m = _exists_re.match(line)
+            if m != None:
+                total = int(m.group(1))
+            m = _code_re.match(line)
+            if m != None:
+                setattr(self, m.group(1).decode('ascii').lower(), int(m.group(2)))
+
+        assert total != None and total > 0
+
+        return total
+
+    async def last_uid(self):
+        """ the highest UID in the selected folder """
+        if self.uidnext != None:
+            return self.uidnext - 1
+        async for seq, attrs in self.fetch('*', 'UID'):
+            return int(attrs[b'UID'])
+        return 0
+
+    async def idle(self, timeout):
+        """
+        Waits in IDLE until the server has news about the selected folder, or
+        for timeout seconds, returns the untagged responses it sent (none
+        when it timed out).  gmail only keeps IDLE going for so long, keep
+        timeout well under 29 minutes.
+        """
+        command = self.__send(('IDLE',))
+        command.continued = asyncio.get_running_loop().create_future()
+        command.news = asyncio.Event()
+        await asyncio.wait([command.continued, command.done], return_when=asyncio.FIRST_COMPLETED)
+        if not command.continued.done() or command.continued.cancelled():
+            # refused, or the connection went away
+            status, text = await command.done
+            raise imaplib.IMAP4.error('IDLE failed: %s %s' % (status, text))
+        try:
+            await asyncio.wait_for(command.news.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self.__error == None:
+            self.__write(b'DONE\r\n')
+        status, text = await command.done
+        if status != 'OK':
+            raise imaplib.IMAP4.error('IDLE failed: %s %s' % (status, text))
+        return command.untagged
+
+    async def logout(self):
+        try:
+            if self.__error == None:
+                await self.check('LOGOUT')
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__dispatcher != None:
+            self.__dispatcher.cancel()
+        self.__writer.close()
+
+    async def __fill(self):
+        """ reads whatever the server sent next into the buffer """
+        while True:
+            try:
+                data = await asyncio.wait_for(self.__reader.read(1 << 16), self.timeout)
+            except asyncio.TimeoutError:
+                # an idle connection is fine, a server that stopped answering isn't
+                if any(command.news == None for command in self.__pending.values()):
+                    raise imaplib.IMAP4.abort('no response from the server for %d seconds' % self.timeout)
+                continue
+            if len(data) == 0:
+                raise imaplib.IMAP4.abort('connection closed by the server')
+            self.bytes_received += len(data)
+            if self.__inflate != None:
+                data = self.__inflate.decompress(data)
+            self.__buffer += data
+            self.raw_bytes_received += len(data)
+            return
+
+    def __start_compression(self):
+        """ after COMPRESS went OK: everything from here on, both ways, is deflated """
+        self.__deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.__inflate = zlib.decompressobj(-15)
+        # whatever already arrived after the OK was compressed too
+        rest = bytes(self.__buffer)
+        self.__buffer.clear()
+        self.raw_bytes_received -= len(rest)
+        self.__buffer += self.__inflate.decompress(rest)
+        self.raw_bytes_received += len(self.__buffer)
+        self.compressed = True
+
+    def __take_response(self):
+        """ the next response out of the buffer, literals and all, or None if it isn't all there yet """
+        buffer = self.__buffer
+        pos = 0
+        while True:
+            end = buffer.find(b'\r\n', pos)
+            if end < 0:
+                return None
+            m = _literal_re.search(buffer, pos, end)
+            if m == None:
+                data = bytes(buffer[:end + 2])
+                # cheap, bytearrays just move their start when cut from the front
+                del buffer[:end + 2]
+                return data
+            # the response goes on after the literal
+            pos = end + 2 + int(m.group(1))
+            if pos > len(buffer):
+                return None
+
+    async def __dispatch(self):
+        """ reads responses for as long as the connection lasts and hands them to their commands """
+        try:
+            while True:
+                data = self.__take_response()
+                if data == None:
+                    await self.__fill()
+                    continue
+                reader = _Reader(io.BytesIO(data))
+                reader.next_line()
+                line = reader.line
+                if line.startswith(b'* '):
+                    m = _fetch_re.match(line)
+                    if m != None:
+                        reader.pos = m.end()
+                        attrs = reader.attributes()
+                        seq = int(m.group(1))
+                        for command in self.__pending.values():
+                            if command.messages != None and command.wants(seq, attrs):
+                                command.size += len(data)
+                                command.messages.put_nowait((seq, attrs))
+                                break
+                        else:
+                            # news nobody asked for, e.g. flags changed elsewhere,
+                            # only interesting while idling
+                            self.__news(line, idling_only=True)
+                            continue
+                        if command.bounded and command.messages.qsize() >= FETCH_BUFFER:
+                            # wait for the reader to catch up
+                            command.drained.clear()
+                            await command.drained.wait()
+                    else:
+                        # with any literals, e.g. for a LIST of an odd name
+                        self.__news(data[:-2])
+                elif line.startswith(b'+'):
+                    # only IDLE waits for a continuation
+                    for command in self.__pending.values():
+                        if command.continued != None and not command.continued.done():
+                            command.continued.set_result(line)
+                            break
+                else:
+                    tag, _, rest = line.partition(b' ')
+                    command = self.__pending.pop(tag, None)
+                    if command == None:
+                        raise imaplib.IMAP4.abort('unexpected response %r' % line[:100])
+                    status, _, text = rest.partition(b' ')
+                    if command.name == 'COMPRESS' and status == b'OK':
+                        self.__start_compression()
+                    command.finish(status.decode('ascii', 'replace'), text.decode('utf-8', 'replace'))
+        except asyncio.CancelledError:
+            self.__fail(imaplib.IMAP4.abort('connection closed'))
+            raise
+        except Exception as err:
+            self.__fail(err)
+
+    def __news(self, line, idling_only=False):
+        """ hands an untagged response to the oldest command """
+        if len(self.__pending) == 0:
+            return
+        command = next(iter(self.__pending.values()))
+        if idling_only and command.news == None:
+            return
+        command.untagged.append(line)
+        # not for keepalives like "* OK Still here"
+        if command.news != None and _news_re.match(line) != None:
+            command.news.set()
+
+    def __fail(self, err):
+        self.__error = err
+        for command in self.__pending.values():
+            command.fail(err)
+        self.__pending.clear()